@@ -1,5 +1,6 @@
-from Bio import SeqIO, Seq
+from Bio import SeqIO
 from advntr.distance import *
+from advntr.utils import get_reverse_complement
 
 
 def match_query_by_sliding_windows(query, query_acgt_content, rc_query_acgt_content, number_of_copies, read_segment):
@@ -17,7 +18,7 @@ def match_query_by_sliding_windows(query, query_acgt_content, rc_query_acgt_cont
 
 def get_candid_reads_by_sliding_window_method(query, number_of_copies, fastq_files):
     candid_reads = []
-    reversed_complement_query = str(Seq.Seq(query).reverse_complement())
+    reversed_complement_query = get_reverse_complement(query)
     query_acgt_content = get_nucleotide_map(query)
     rc_query_acgt_content = get_nucleotide_map(reversed_complement_query)
     for fastq_file in fastq_files:
@@ -2,8 +2,6 @@ import logging
 import os
 import sys
 
-from Bio import SeqIO
-
 from advntr.genome_analyzer import GenomeAnalyzer
 from advntr.models import load_unique_vntrs_data, get_largest_id_in_database, save_reference_vntr_to_database
 from advntr.models import delete_vntr_from_database, create_vntrs_database
@@ -11,6 +9,7 @@ from advntr.reference_vntr import ReferenceVNTR
 from advntr.vntr_finder import VNTRFinder
 from advntr import settings
 from advntr import __version__
+from advntr.utils import read_fasta_sequences
 
 
 def valid_vntr_for_frameshift(target_vntrs):
@@ -191,11 +190,8 @@ def add_model(args, addmodel_parser):
     chromosome = args.chromosome
     chr_sequence = ''
 
-    fasta_sequences = SeqIO.parse(open(args.reference), 'fasta')
-    for fasta in fasta_sequences:
-        name, sequence = fasta.id, str(fasta.seq)
-        if name == chromosome:
-            chr_sequence = sequence
+    for name, sequence in read_fasta_sequences(args.reference, names=(chromosome,)):
+        chr_sequence = sequence
 
     if args.models is not None:
         settings.TRAINED_MODELS_DB = args.models
@@ -56,27 +56,27 @@ def align_with_bowtie(fq_file):
         make_bam_and_index(bowtie_alignment)
     return bowtie_alignment[:-4] + '.bam'
 
+def get_nucleotide_codes_table():
+    table = bytearray(256)
+    for code, nucleotides in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+        for nucleotide in nucleotides:
+            table[ord(nucleotide)] = code
+    return bytes(table)
+
+
+# Translation table from ASCII to the code of each nucleotide, any other character has code 0 like 'A'
+NUCLEOTIDE_CODES = get_nucleotide_codes_table()
+
+
 def get_embedding_of_string(sequence, kmer_length=6):
     input_dim = 4 ** kmer_length
-    sequence = sequence.upper()
-    num = 0
-    mapping = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
-    for c in 'ASDFGHJKLPOIUYTREWQZXCVBNM':
-        if c not in mapping.keys():
-            mapping[c] = 0
-    for i in range(len(sequence[:kmer_length])):
-        num += mapping[sequence[i]] * (4 ** (kmer_length - i - 1))
-    result = [0] * input_dim
-    result[num] = 1
-    # result = set()
-    # result.add(num)
-    highest_position = 4 ** (kmer_length-1)
-    for i in range(kmer_length, len(sequence)):
-        num -= highest_position * mapping[sequence[i-kmer_length]]
-        num *= 4
-        num += mapping[sequence[i]]
-        result[num] = 1
-        # result.add(num)
+    codes = np.frombuffer(sequence.encode('ascii').translate(NUCLEOTIDE_CODES), dtype=np.uint8).astype(np.int64)
+    windows = max(len(codes) - kmer_length + 1, 1)
+    kmers = np.zeros(windows, dtype=np.int64)
+    for i in range(min(kmer_length, len(codes))):
+        kmers += codes[i:i + windows] * (4 ** (kmer_length - i - 1))
+    result = np.zeros(input_dim, dtype=int)
+    result[kmers] = 1
     return result
 
 
@@ -1,3 +1,4 @@
+from collections import defaultdict
 import logging
 import os
 
@@ -207,16 +208,30 @@ class GenomeAnalyzer:
 
         return reads, vntr_read_ids
 
+    @staticmethod
+    def get_read_indices_by_id(reads):
+        read_indices = defaultdict(list)
+        for i, read in enumerate(reads):
+            read_indices[read.id].append(i)
+        return read_indices
+
+    @staticmethod
+    def get_reads_by_ids(reads, read_indices, read_ids):
+        """Return the reads with the given ids, in the same order as they are in reads."""
+        indices = sorted(i for read_id in set(read_ids) if read_id in read_indices for i in read_indices[read_id])
+        return [reads[i] for i in indices]
+
     def find_repeat_counts_from_pacbio_alignment_file(self, alignment_file, log_pacbio_reads, accuracy_filter):
         unmapped_reads_file = extract_unmapped_reads_to_fasta_file(alignment_file, self.working_dir, self.ref_filename)
         filtered_reads, vntr_reads_ids = self.get_vntr_filtered_reads_map(unmapped_reads_file, False)
+        read_indices = self.get_read_indices_by_id(filtered_reads)
 
         if self.outfmt == 'bed':
             self.print_bed_header()
         if self.outfmt == 'vcf':
             self.print_vcf_header()
         for vid in self.target_vntr_ids:
-            reads = [read for read in filtered_reads if read.id in vntr_reads_ids[vid]]
+            reads = self.get_reads_by_ids(filtered_reads, read_indices, vntr_reads_ids[vid])
             try:
                 genotype_result = self.vntr_finder[vid].find_repeat_count_from_pacbio_alignment_file(
                                             alignment_file=alignment_file,
@@ -235,12 +250,13 @@ class GenomeAnalyzer:
 
     def find_repeat_counts_from_pacbio_reads(self, read_file, log_pacbio_reads, accuracy_filter, naive=False):
         filtered_reads, vntr_reads_ids = self.get_vntr_filtered_reads_map(read_file, False)
+        read_indices = self.get_read_indices_by_id(filtered_reads)
         if self.outfmt == 'bed':
             self.print_bed_header()
         if self.outfmt == 'vcf':
             self.print_vcf_header()
         for vid in self.target_vntr_ids:
-            unmapped_reads = [read for read in filtered_reads if read.id in vntr_reads_ids[vid]]
+            unmapped_reads = self.get_reads_by_ids(filtered_reads, read_indices, vntr_reads_ids[vid])
             try:
                 genotype_result = self.vntr_finder[vid].find_repeat_count_from_pacbio_reads(
                                         unmapped_filtered_reads=unmapped_reads,
@@ -273,12 +289,13 @@ class GenomeAnalyzer:
     def find_repeat_counts_from_alignment_file(self, alignment_file, accuracy_filter, average_coverage, update=False):
         unmapped_reads_file = extract_unmapped_reads_to_fasta_file(alignment_file, self.working_dir, self.ref_filename)
         filtered_reads, vntr_reads_ids = self.get_vntr_filtered_reads_map(unmapped_reads_file)
+        read_indices = self.get_read_indices_by_id(filtered_reads)
         if self.outfmt == 'bed':
             self.print_bed_header()
         if self.outfmt == 'vcf':
             self.print_vcf_header()
         for vid in self.target_vntr_ids:
-            unmapped_reads = [read for read in filtered_reads if read.id in vntr_reads_ids[vid]]
+            unmapped_reads = self.get_reads_by_ids(filtered_reads, read_indices, vntr_reads_ids[vid])
             try:
                 genotype_result = self.vntr_finder[vid].find_repeat_count_from_alignment_file(
                                     alignment_file=alignment_file,
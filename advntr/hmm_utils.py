@@ -1,6 +1,7 @@
 import numpy as np
 
 import logging
+import networkx
 from pomegranate import DiscreteDistribution, State
 from pomegranate import HiddenMarkovModel as Model
 from advntr.profile_hmm import build_profile_hmm_for_repeats, build_profile_hmm_pseudocounts_for_alignment
@@ -8,57 +9,65 @@ from advntr.profiler import time_usage
 from advntr import settings
 
 
+MATCH_EMISSION_TEMPLATES = {base: dict({'A': 0.01, 'C': 0.01, 'G': 0.01, 'T': 0.01}, **{base: 0.97})
+                            for base in 'ACGT'}
+EMITTING_STATE_PREFIXES = ('M', 'I', 'start_random_matches', 'end_random_matches')
+# Edges and state offsets of a profile HMM unit by its length. Only the probabilities differ between patterns.
+PROFILE_UNIT_LAYOUTS = {}
+
+
 def path_to_alignment(x, y, path):
-    for i, (index, state) in enumerate(path[1:-1]):
+    # Every state of the path is an alignment column: deletions put a gap in y, insertions put a gap in x and
+    # all the other states take the next character of each sequence.
+    aligned_x = []
+    aligned_y = []
+    x_index = 0
+    y_index = 0
+    for index, state in path[1:-1]:
         name = state.name
 
         if name.startswith('D'):
-            y = y[:i] + '-' + y[i:]
-        elif name.startswith('I'):
-            x = x[:i] + '-' + x[i:]
+            aligned_y.append('-')
+        elif y_index < len(y):
+            aligned_y.append(y[y_index])
+            y_index += 1
+        if name.startswith('I'):
+            aligned_x.append('-')
+        elif x_index < len(x):
+            aligned_x.append(x[x_index])
+            x_index += 1
 
-    return x, y
+    return ''.join(aligned_x) + x[x_index:], ''.join(aligned_y) + y[y_index:]
 
 
 def get_multiple_alignment_of_viterbi_paths(repeats_sequences, repeats_visited_states):
     alignment_states = {}
     multiple_alignment_length = 0
     for repeat_visited_states in repeats_visited_states:
-        state_map = {}
-        for visited_state in repeat_visited_states:
-            visited_state = visited_state.split('_')[0]
-            if visited_state not in state_map.keys():
-                state_map[visited_state] = 0
-            state_map[visited_state] += 1
-        for key, value in state_map.items():
-            index = int(key.split('_')[0][1:])
-            multiple_alignment_length = max(multiple_alignment_length, index)
-            if key not in alignment_states.keys():
-                alignment_states[key] = value
-            alignment_states[key] = max(alignment_states[key], value)
+        if not len(repeat_visited_states):
+            continue
+        prefixes = np.char.partition(np.asarray(repeat_visited_states, dtype=str), '_')[:, 0]
+        keys, counts = np.unique(prefixes, return_counts=True)
+        multiple_alignment_length = max(multiple_alignment_length, int(np.char.lstrip(keys, 'MID').astype(int).max()))
+        for key, value in zip(keys.tolist(), counts.tolist()):
+            alignment_states[key] = max(alignment_states.get(key, 0), value)
 
     alignment_visited_states = []
     for i in range(multiple_alignment_length+1):
         key = 'M%s' % i
-        if key in alignment_states.keys():
-            for j in range(alignment_states[key]):
-                alignment_visited_states.append(key)
+        alignment_visited_states += [key] * alignment_states.get(key, 0)
         key = 'I%s' % i
-        if key in alignment_states.keys():
-            for j in range(alignment_states[key]):
-                alignment_visited_states.append(key)
+        alignment_visited_states += [key] * alignment_states.get(key, 0)
 
     alignment = ['' for _ in range(len(repeats_sequences))]
     for i, repeat_sequence in enumerate(repeats_sequences):
         sequence_index = 0
-        individual_alignment = [state.split('_')[0] for state in repeats_visited_states[i]]
+        # The first alignment column of a state consumes every occurrence of it in the repeat
+        remaining_states = set(state.split('_')[0] for state in repeats_visited_states[i])
         for state in alignment_visited_states:
-            found = False
-            for k, ind_state in enumerate(individual_alignment):
-                if state == ind_state:
-                    individual_alignment[k] = 'DELETED'
-                    found = True
+            found = state in remaining_states
             if found:
+                remaining_states.discard(state)
                 alignment[i] += repeat_sequence[sequence_index]
                 sequence_index += 1
             else:
@@ -73,20 +82,16 @@ def extract_repeating_segments_from_read(sequence, visited_states):
     prev_start = None
     prev_start_state = None
     sequence_index = 0
-    for i in range(len(visited_states)):
-        if visited_states[i].startswith('unit_end') and prev_start is not None:
-            repeat = ''
-            vpath = []
-            for j in range(prev_start, sequence_index):
-                repeat += sequence[j]
-            for j in range(prev_start_state+1, i):
-                vpath.append(visited_states[j])
-            repeats.append(repeat)
-            vpaths.append(vpath)
-        if visited_states[i].startswith('unit_start'):
+    emitting_prefixes = EMITTING_STATE_PREFIXES
+    for i, state_name in enumerate(visited_states):
+        startswith = state_name.startswith
+        if startswith('unit_end') and prev_start is not None:
+            repeats.append(sequence[prev_start:sequence_index])
+            vpaths.append(visited_states[prev_start_state+1:i])
+        elif startswith('unit_start'):
             prev_start = sequence_index
             prev_start_state = i
-        if is_emitting_state(visited_states[i]):
+        elif startswith(emitting_prefixes):
             sequence_index += 1
     return repeats, vpaths
 
@@ -95,7 +100,7 @@ def get_multiple_alignment_of_repeats_from_reads(sequence_vpath_list):
     repeats_sequences = []
     repeats_visited_states = []
     for sequence, vpath in sequence_vpath_list:
-        visited_states = [state.name for idx, state in vpath[1:-1]]
+        visited_states = get_vpath_summary(vpath).visited_states
         repeats, repeats_vstates = extract_repeating_segments_from_read(sequence, visited_states)
         repeats_sequences += repeats
         repeats_visited_states += repeats_vstates
@@ -105,40 +110,95 @@ def get_multiple_alignment_of_repeats_from_reads(sequence_vpath_list):
 
 def get_emitted_basepair_from_visited_states(state, visited_states, sequence):
     base_pair_idx = 0
+    emitting_prefixes = EMITTING_STATE_PREFIXES
     for visited_state in visited_states:
         if visited_state == state:
             return sequence[base_pair_idx]
-        if is_emitting_state(visited_state):
+        if visited_state.startswith(emitting_prefixes):
             base_pair_idx += 1
     return None
 
 
+def get_emitted_basepairs_of_visited_states(visited_states, sequence):
+    """Map every visited state to the base pair returned for it by get_emitted_basepair_from_visited_states."""
+    emitted_basepairs = {}
+    base_pair_idx = 0
+    emitting_prefixes = EMITTING_STATE_PREFIXES
+    for visited_state in visited_states:
+        if visited_state not in emitted_basepairs:
+            emitted_basepairs[visited_state] = sequence[base_pair_idx] if base_pair_idx < len(sequence) else None
+        if visited_state.startswith(emitting_prefixes):
+            base_pair_idx += 1
+    return emitted_basepairs
+
+
 def is_match_state(state_name):
-    if state_name.startswith('M'):
-        return True
-    return False
+    return state_name.startswith('M')
 
 
 def is_emitting_state(state_name):
-    if state_name.startswith('M') or state_name.startswith('I') or state_name.startswith('start_random_matches') \
-            or state_name.startswith('end_random_matches'):
-        return True
-    return False
+    return state_name.startswith(EMITTING_STATE_PREFIXES)
+
+
+class VPathSummary(object):
+    """Visited state names of a viterbi path along with per-state masks computed once from the names.
+
+    Functions that take a vpath also accept a summary, so a read that is queried several times only has its
+    state names parsed once. Summaries taken from a model's states reuse its masks without parsing any name.
+    """
+
+    def __init__(self, visited_states):
+        self.visited_states = visited_states
+        self.is_match = np.array([name.startswith('M') for name in visited_states], dtype=bool)
+        self.is_emitting = np.array([name.startswith(EMITTING_STATE_PREFIXES) for name in visited_states], dtype=bool)
+        self.endswith_prefix = np.array([name.endswith('prefix') for name in visited_states], dtype=bool)
+        self.endswith_suffix = np.array([name.endswith('suffix') for name in visited_states], dtype=bool)
+        self.is_unit_start = np.array([name.startswith('unit_start') for name in visited_states], dtype=bool)
+        self.is_unit_end = np.array([name.startswith('unit_end') for name in visited_states], dtype=bool)
+        self.hmm_index = np.array([int(name.split('_')[0][1:]) if 'start' not in name and 'end' not in name else -1
+                                   for name in visited_states], dtype=int)
+
+    def __len__(self):
+        return len(self.visited_states)
+
+    def take(self, indices):
+        """Return the summary of the states at the given indices without parsing their names again."""
+        summary = VPathSummary.__new__(VPathSummary)
+        summary.visited_states = [self.visited_states[i] for i in indices]
+        for mask in ('is_match', 'is_emitting', 'endswith_prefix', 'endswith_suffix', 'is_unit_start', 'is_unit_end',
+                     'hmm_index'):
+            setattr(summary, mask, getattr(self, mask)[indices])
+        return summary
+
+
+def get_model_state_summary(model):
+    """Summarize all the states of a model, so vpaths it decodes can be summarized by state index.
+
+    The summary is meant to be built once by the caller that owns the model and passed to get_vpath_summary.
+    """
+    return VPathSummary([state.name for state in model.states])
+
+
+def get_vpath_summary(vpath, model_summary=None):
+    """Summarize a vpath. With the state summary of the model that decoded it, masks are taken by state index."""
+    if isinstance(vpath, VPathSummary):
+        return vpath
+    if model_summary is None:
+        return VPathSummary([state.name for idx, state in vpath[1:-1]])
+    return model_summary.take(np.array([idx for idx, state in vpath[1:-1]], dtype=int))
 
 
 def get_repeating_pattern_lengths(visited_states):
-    lengths = []
-    prev_start = None
-    for i in range(len(visited_states)):
-        if visited_states[i].startswith('unit_end') and prev_start is not None:
-            current_len = 0
-            for j in range(prev_start, i):
-                if is_emitting_state(visited_states[j]):
-                    current_len += 1
-            lengths.append(current_len)
-        if visited_states[i].startswith('unit_start'):
-            prev_start = i
-    return lengths
+    summary = visited_states if isinstance(visited_states, VPathSummary) else VPathSummary(visited_states)
+    # emitted_bps[i] is the number of base pairs emitted before the i-th state
+    emitted_bps = np.concatenate(([0], np.cumsum(summary.is_emitting)))
+    unit_starts = np.flatnonzero(summary.is_unit_start)
+    unit_ends = np.flatnonzero(summary.is_unit_end)
+    # Each unit end closes the repeat opened by the last unit start before it
+    last_starts = np.searchsorted(unit_starts, unit_ends) - 1
+    closed = last_starts >= 0
+    lengths = emitted_bps[unit_ends[closed]] - emitted_bps[unit_starts[last_starts[closed]]]
+    return lengths.tolist()
 
 
 def get_repeat_segments_from_visited_states_and_region(visited_states, region):
@@ -153,66 +213,38 @@ def get_repeat_segments_from_visited_states_and_region(visited_states, region):
 
 
 def get_number_of_repeats_in_vpath(vpath):
-    starts = 0
-    ends = 0
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-
-    read_length = 0
-    for vs in visited_states:
-        if is_emitting_state(vs):
-            read_length += 1
+    summary = get_vpath_summary(vpath)
+    current_bp = np.cumsum(summary.is_emitting)
+    read_length = current_bp[-1] if len(current_bp) else 0
 
     minimum_required_bp_in_repeat = 3
-    current_bp = 0
-    first_end = None
-    last_end = None
-    first_start = None
-    last_start = None
-    for i in range(len(visited_states)):
-        if is_emitting_state(visited_states[i]):
-            current_bp += 1
-        if visited_states[i].startswith('unit_start') and read_length - current_bp >= minimum_required_bp_in_repeat:
-            if first_start is None:
-                first_start = current_bp
-            last_start = current_bp
-            starts += 1
-        if visited_states[i].startswith('unit_end') and current_bp >= minimum_required_bp_in_repeat:
-            if first_end is None:
-                first_end = current_bp
-            last_end = current_bp
-            ends += 1
+    start_bps = current_bp[summary.is_unit_start & (read_length - current_bp >= minimum_required_bp_in_repeat)]
+    end_bps = current_bp[summary.is_unit_end & (current_bp >= minimum_required_bp_in_repeat)]
+    starts = len(start_bps)
+    ends = len(end_bps)
     delta = 0
-    if last_start is not None and first_start is not None and last_end is not None and first_end is not None:
-        if first_end < first_start and last_start > last_end:
+    if starts and ends:
+        if end_bps[0] < start_bps[0] and start_bps[-1] > end_bps[-1]:
             delta = 1
     return max(starts, ends) + delta
 
 
 def get_number_of_matches_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_match_state(visited_states[i]):
-            result += 1
-    return result
+    return int(np.count_nonzero(get_vpath_summary(vpath).is_match))
 
 
 def get_number_of_repeat_bp_matches_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_emitting_state(visited_states[i]) and not visited_states[i].endswith('fix'):
-            result += 1
-    return result
+    summary = get_vpath_summary(vpath)
+    return int(np.count_nonzero(summary.is_emitting & ~(summary.endswith_prefix | summary.endswith_suffix)))
+
+
+def encode_sequence(sequence):
+    return np.frombuffer(str(sequence).encode('ascii'), dtype=np.uint8)
 
 
 def get_flanking_regions_matching_rate(vpath, sequence, left_flank, right_flank, accuracy_filter=False, verbose=False):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    right_flanking_matches = 0
-    right_flanking_basepairs = 0
-    left_flanking_matches = 0
-    left_flanking_basepairs = 0
-    seq_index = 0
+    summary = get_vpath_summary(vpath)
+    visited_states = summary.visited_states
     max_hmm_index = -1
     prev_state = visited_states[0]
     for state in visited_states:
@@ -220,40 +252,48 @@ def get_flanking_regions_matching_rate(vpath, sequence, left_flank, right_flank,
             max_hmm_index = int(prev_state.split("_")[0][1:])
             break
         prev_state = state
+
+    # States without an hmm index (start, end and random match states) are skipped and do not consume sequence
+    hmm_states = summary.hmm_index >= 0
+    emitting = summary.is_emitting & hmm_states
+    seq_indices = np.cumsum(emitting) - emitting
+    hmm_index = summary.hmm_index
+    right_states = hmm_states & summary.endswith_prefix
+    left_states = hmm_states & summary.endswith_suffix
     if verbose:
         logging.debug("len visited_states {}".format(len(visited_states)))
-    for i in range(len(visited_states)):
-        if 'start' in visited_states[i] or 'end' in visited_states[i]:
-            continue
-        hmm_state = int(visited_states[i].split("_")[0][1:])
-        if visited_states[i].endswith('prefix'):
-            if verbose:
+        for i in np.flatnonzero(right_states | left_states):
+            if right_states[i]:
                 logging.debug("state {} is matching {} seq_index {} sequence[seq_index] {} right_flank[hmm_state - 1] {} is emitting {}".format(
                           visited_states[i],
-                          is_match_state(visited_states[i]),
-                          seq_index,
-                          sequence[seq_index],
-                          right_flank[hmm_state - 1],
-                          is_emitting_state(visited_states[i])))
-            if is_match_state(visited_states[i]) and sequence[seq_index] == right_flank[hmm_state - 1]:
-                right_flanking_matches += 1
-            if is_emitting_state(visited_states[i]):
-                right_flanking_basepairs += 1
-        if visited_states[i].endswith('suffix'):
-            if verbose:
+                          summary.is_match[i],
+                          seq_indices[i],
+                          sequence[seq_indices[i]],
+                          right_flank[hmm_index[i] - 1],
+                          summary.is_emitting[i]))
+            else:
                 logging.debug("state {} is matching {} seq_index {} sequence[seq_index] {} left_flank[-(max_hmm_index - hmm_state + 1)] {} is emitting {}".format(
                           visited_states[i],
-                          is_match_state(visited_states[i]),
-                          seq_index,
-                          sequence[seq_index],
-                          left_flank[-(max_hmm_index - hmm_state + 1)],
-                          is_emitting_state(visited_states[i])))
-            if is_match_state(visited_states[i]) and sequence[seq_index] == left_flank[-(max_hmm_index - hmm_state + 1)]:
-                left_flanking_matches += 1
-            if is_emitting_state(visited_states[i]):
-                left_flanking_basepairs += 1
-        if is_emitting_state(visited_states[i]):
-            seq_index += 1
+                          summary.is_match[i],
+                          seq_indices[i],
+                          sequence[seq_indices[i]],
+                          left_flank[-(max_hmm_index - hmm_index[i] + 1)],
+                          summary.is_emitting[i]))
+
+    encoded_sequence = encode_sequence(sequence)
+    right_matches = right_states & summary.is_match
+    right_flank_indices = hmm_index[right_matches] - 1
+    right_flank_indices[right_flank_indices < 0] += len(right_flank)
+    right_flanking_matches = np.count_nonzero(encoded_sequence[seq_indices[right_matches]] ==
+                                              encode_sequence(right_flank)[right_flank_indices])
+    right_flanking_basepairs = np.count_nonzero(right_states & summary.is_emitting)
+
+    left_matches = left_states & summary.is_match
+    left_flank_indices = -(max_hmm_index - hmm_index[left_matches] + 1)
+    left_flank_indices[left_flank_indices < 0] += len(left_flank)
+    left_flanking_matches = np.count_nonzero(encoded_sequence[seq_indices[left_matches]] ==
+                                             encode_sequence(left_flank)[left_flank_indices])
+    left_flanking_basepairs = np.count_nonzero(left_states & summary.is_emitting)
     if accuracy_filter:
         # If accuracy filter is set, we want to be conservative in read recruiting.
         # Therefore, in case of zero bp right (or left) flanking match, read is not confidently spanning the VNTR, so return 0.
@@ -268,233 +308,185 @@ def get_flanking_regions_matching_rate(vpath, sequence, left_flank, right_flank,
     return result
 
 
+def get_flanking_region_sizes_in_vpath(vpath):
+    """Return the number of base pairs of the read that are emitted by the left and the right flanking regions."""
+    summary = get_vpath_summary(vpath)
+    left_size = int(np.count_nonzero(summary.is_emitting & summary.endswith_suffix))
+    right_size = int(np.count_nonzero(summary.is_emitting & summary.endswith_prefix))
+    return left_size, right_size
+
+
 def get_left_flanking_region_size_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_emitting_state(visited_states[i]) and visited_states[i].endswith('suffix'):
-            result += 1
-    return result
+    return get_flanking_region_sizes_in_vpath(vpath)[0]
 
 
 def get_right_flanking_region_size_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_emitting_state(visited_states[i]) and visited_states[i].endswith('prefix'):
-            result += 1
-    return result
+    return get_flanking_region_sizes_in_vpath(vpath)[1]
+
+
+def get_match_emission(base):
+    if base in MATCH_EMISSION_TEMPLATES:
+        return MATCH_EMISSION_TEMPLATES[base].copy()
+    distribution_map = dict({'A': 0.01, 'C': 0.01, 'G': 0.01, 'T': 0.01})
+    distribution_map[base] = 0.97
+    return distribution_map
+
+
+def get_profile_unit_state_names(length, hmm_name):
+    names = ['I%s_%s' % (i, hmm_name) for i in range(length + 1)]
+    names += ['M%s_%s' % (i, hmm_name) for i in range(1, length + 1)]
+    names += ['D%s_%s' % (i, hmm_name) for i in range(1, length + 1)]
+    return names
+
+
+def get_profile_unit_layout(length):
+    """Return the transitions inside one profile HMM unit as a list of edges and their state offsets.
+
+    States of a unit are laid out as I0..In, M1..Mn, D1..Dn, unit_start, unit_end.
+    """
+    if length in PROFILE_UNIT_LAYOUTS:
+        return PROFILE_UNIT_LAYOUTS[length]
+    offsets = {'unit_start': 3 * length + 1, 'unit_end': 3 * length + 2}
+    for i in range(length + 1):
+        offsets['I%s' % i] = i
+    for i in range(1, length + 1):
+        offsets['M%s' % i] = length + i
+        offsets['D%s' % i] = 2 * length + i
+
+    n = length
+    edges = [('unit_start', 'M1'), ('unit_start', 'D1'), ('unit_start', 'I0'),
+             ('I0', 'I0'), ('I0', 'D1'), ('I0', 'M1'),
+             ('D%s' % n, 'unit_end'), ('D%s' % n, 'I%s' % n),
+             ('M%s' % n, 'unit_end'), ('M%s' % n, 'I%s' % n),
+             ('I%s' % n, 'I%s' % n), ('I%s' % n, 'unit_end')]
+    for i in range(1, length + 1):
+        edges += [('M%s' % i, 'I%s' % i), ('D%s' % i, 'I%s' % i), ('I%s' % i, 'I%s' % i)]
+        if i < length:
+            edges += [('I%s' % i, 'M%s' % (i + 1)), ('I%s' % i, 'D%s' % (i + 1)),
+                      ('M%s' % i, 'M%s' % (i + 1)), ('M%s' % i, 'D%s' % (i + 1)),
+                      ('D%s' % i, 'M%s' % (i + 1)), ('D%s' % i, 'D%s' % (i + 1))]
+    rows = np.array([offsets[a] for a, b in edges])
+    columns = np.array([offsets[b] for a, b in edges])
+    PROFILE_UNIT_LAYOUTS[length] = (edges, rows, columns)
+    return PROFILE_UNIT_LAYOUTS[length]
+
+
+def get_profile_unit_transitions(length, transition):
+    """Return the state offsets and probabilities of the transitions inside one profile HMM unit.
+
+    transition(a, b) gives the probability of going from profile state a to b, e.g. transition('M1', 'I1').
+    """
+    edges, rows, columns = get_profile_unit_layout(length)
+    probabilities = np.array([transition(a, b) for a, b in edges])
+    return rows, columns, probabilities
+
+
+def build_model_from_matrix(name, mat, distributions, state_names, starts, ends, merge=None):
+    """Create a model from a dense transition matrix, adding only its non-zero transitions."""
+    model = Model(name=name)
+    states = [State(distribution, name=state_name) for distribution, state_name in zip(distributions, state_names)]
+    model.add_states(states)
+    for i in np.flatnonzero(starts):
+        model.add_transition(model.start, states[i], starts[i])
+    rows, columns = np.nonzero(mat)
+    model.add_transitions([states[i] for i in rows], [states[j] for j in columns], mat[rows, columns].tolist())
+    for i in np.flatnonzero(ends):
+        model.add_transition(states[i], model.end, ends[i])
+    model.bake(merge=merge)
+    return model
 
 
-@time_usage
-def get_prefix_matcher_hmm(pattern):
-    model = Model(name="Prefix Matcher HMM Model")
+def get_flanking_region_matcher_hmm(pattern, hmm_name, name):
+    length = len(pattern)
     insert_distribution = DiscreteDistribution({'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25})
-    insert_states = []
-    match_states = []
-    delete_states = []
-    hmm_name = 'prefix'
-    for i in range(len(pattern) + 1):
-        insert_states.append(State(insert_distribution, name='I%s_%s' % (i, hmm_name)))
-
-    for i in range(len(pattern)):
-        distribution_map = dict({'A': 0.01, 'C': 0.01, 'G': 0.01, 'T': 0.01})
-        distribution_map[pattern[i]] = 0.97
-        match_states.append(State(DiscreteDistribution(distribution_map), name='M%s_%s' % (str(i + 1), hmm_name)))
-
-    for i in range(len(pattern)):
-        delete_states.append(State(None, name='D%s_%s' % (str(i + 1), hmm_name)))
-
-    unit_start = State(None, name='prefix_start_%s' % hmm_name)
-    unit_end = State(None, name='prefix_end_%s' % hmm_name)
-    model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
-    last = len(delete_states)-1
-
-    model.add_transition(model.start, unit_start, 1)
-
-    model.add_transition(unit_end, model.end, 1)
+    distributions = [insert_distribution for _ in range(length + 1)]
+    for i in range(length):
+        distributions.append(DiscreteDistribution(get_match_emission(pattern[i])))
+    distributions += [None for _ in range(length + 2)]
+    state_names = get_profile_unit_state_names(length, hmm_name)
+    state_names += ['%s_start_%s' % (hmm_name, hmm_name), '%s_end_%s' % (hmm_name, hmm_name)]
 
     insert_error = settings.MAX_ERROR_RATE * 2 / 5
     delete_error = settings.MAX_ERROR_RATE * 1 / 5
-    model.add_transition(unit_start, match_states[0], 1 - insert_error - delete_error)
-    model.add_transition(unit_start, delete_states[0], delete_error)
-    model.add_transition(unit_start, insert_states[0], insert_error)
-
-    model.add_transition(insert_states[0], insert_states[0], insert_error)
-    model.add_transition(insert_states[0], delete_states[0], delete_error)
-    model.add_transition(insert_states[0], match_states[0], 1 - insert_error - delete_error)
 
-    model.add_transition(delete_states[last], unit_end, 1 - insert_error)
-    model.add_transition(delete_states[last], insert_states[last+1], insert_error)
-
-    model.add_transition(match_states[last], unit_end, 1 - insert_error)
-    model.add_transition(match_states[last], insert_states[last+1], insert_error)
-
-    model.add_transition(insert_states[last+1], insert_states[last+1], insert_error)
-    model.add_transition(insert_states[last+1], unit_end, 1 - insert_error)
-
-    for i in range(0, len(pattern)):
-        model.add_transition(match_states[i], insert_states[i+1], insert_error)
-        model.add_transition(delete_states[i], insert_states[i+1], insert_error)
-        model.add_transition(insert_states[i+1], insert_states[i+1], insert_error)
-        if i < len(pattern) - 1:
-            model.add_transition(insert_states[i+1], match_states[i+1], 1 - insert_error - delete_error)
-            model.add_transition(insert_states[i+1], delete_states[i+1], delete_error)
-
-            model.add_transition(match_states[i], match_states[i+1], 1 - insert_error - delete_error - 0.01)
-            model.add_transition(match_states[i], delete_states[i+1], delete_error)
-            model.add_transition(match_states[i], unit_end, 0.01)
+    def transition(a, b):
+        if b.startswith('M'):
+            if hmm_name == 'suffix' and a == 'unit_start':
+                return (1 - insert_error - delete_error) / length
+            if hmm_name == 'prefix' and a.startswith('M'):
+                return 1 - insert_error - delete_error - 0.01
+            return 1 - insert_error - delete_error
+        if b.startswith('D'):
+            return delete_error
+        if b.startswith('I'):
+            return insert_error
+        return 1 - insert_error
+
+    states_count = len(state_names)
+    unit_start = states_count - 2
+    unit_end = states_count - 1
+    mat = np.zeros((states_count, states_count))
+    rows, columns, probabilities = get_profile_unit_transitions(length, transition)
+    mat[rows, columns] = probabilities
+    if hmm_name == 'prefix':
+        mat[length + 1:2 * length, unit_end] = 0.01
+    else:
+        mat[unit_start, length + 1:2 * length + 1] = (1 - insert_error - delete_error) / length
 
-            model.add_transition(delete_states[i], delete_states[i+1], delete_error)
-            model.add_transition(delete_states[i], match_states[i+1], 1 - insert_error - delete_error)
+    starts = np.zeros(states_count)
+    starts[unit_start] = 1.0
+    ends = np.zeros(states_count)
+    ends[unit_end] = 1.0
+    return build_model_from_matrix(name, mat, distributions, state_names, starts, ends, merge=None)
 
-    model.bake(merge=None)
 
-    return model
+@time_usage
+def get_prefix_matcher_hmm(pattern):
+    return get_flanking_region_matcher_hmm(pattern, 'prefix', "Prefix Matcher HMM Model")
 
 
 @time_usage
 def get_suffix_matcher_hmm(pattern):
-    model = Model(name="Suffix Matcher HMM Model")
-    insert_distribution = DiscreteDistribution({'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25})
-    insert_states = []
-    match_states = []
-    delete_states = []
-    hmm_name = 'suffix'
-    for i in range(len(pattern) + 1):
-        insert_states.append(State(insert_distribution, name='I%s_%s' % (i, hmm_name)))
-
-    for i in range(len(pattern)):
-        distribution_map = dict({'A': 0.01, 'C': 0.01, 'G': 0.01, 'T': 0.01})
-        distribution_map[pattern[i]] = 0.97
-        match_states.append(State(DiscreteDistribution(distribution_map), name='M%s_%s' % (str(i + 1), hmm_name)))
-
-    for i in range(len(pattern)):
-        delete_states.append(State(None, name='D%s_%s' % (str(i + 1), hmm_name)))
-
-    unit_start = State(None, name='suffix_start_%s' % hmm_name)
-    unit_end = State(None, name='suffix_end_%s' % hmm_name)
-    model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
-    last = len(delete_states)-1
-
-    model.add_transition(model.start, unit_start, 1)
-
-    model.add_transition(unit_end, model.end, 1)
-
-    insert_error = settings.MAX_ERROR_RATE * 2 / 5
-    delete_error = settings.MAX_ERROR_RATE * 1 / 5
-    model.add_transition(unit_start, delete_states[0], delete_error)
-    model.add_transition(unit_start, insert_states[0], insert_error)
-    for i in range(len(pattern)):
-        model.add_transition(unit_start, match_states[i], (1 - insert_error - delete_error) / len(pattern))
-
-    model.add_transition(insert_states[0], insert_states[0], insert_error)
-    model.add_transition(insert_states[0], delete_states[0], delete_error)
-    model.add_transition(insert_states[0], match_states[0], 1 - insert_error - delete_error)
-
-    model.add_transition(delete_states[last], unit_end, 1 - insert_error)
-    model.add_transition(delete_states[last], insert_states[last+1], insert_error)
-
-    model.add_transition(match_states[last], unit_end, 1 - insert_error)
-    model.add_transition(match_states[last], insert_states[last+1], insert_error)
-
-    model.add_transition(insert_states[last+1], insert_states[last+1], insert_error)
-    model.add_transition(insert_states[last+1], unit_end, 1 - insert_error)
-
-    for i in range(0, len(pattern)):
-        model.add_transition(match_states[i], insert_states[i+1], insert_error)
-        model.add_transition(delete_states[i], insert_states[i+1], insert_error)
-        model.add_transition(insert_states[i+1], insert_states[i+1], insert_error)
-        if i < len(pattern) - 1:
-            model.add_transition(insert_states[i+1], match_states[i+1], 1 - insert_error - delete_error)
-            model.add_transition(insert_states[i+1], delete_states[i+1], delete_error)
-
-            model.add_transition(match_states[i], match_states[i+1], 1 - insert_error - delete_error)
-            model.add_transition(match_states[i], delete_states[i+1], delete_error)
-
-            model.add_transition(delete_states[i], delete_states[i+1], delete_error)
-            model.add_transition(delete_states[i], match_states[i+1], 1 - insert_error - delete_error)
-
-    model.bake(merge=None)
-
-    return model
+    return get_flanking_region_matcher_hmm(pattern, 'suffix', "Suffix Matcher HMM Model")
 
 
 @time_usage
 def get_constant_number_of_repeats_matcher_hmm(patterns, copies, vpaths):
-    model = Model(name="Repeating Pattern Matcher HMM Model")
-
     if vpaths:
         alignment = get_multiple_alignment_of_repeats_from_reads(vpaths)
         transitions, emissions = build_profile_hmm_pseudocounts_for_alignment(settings.MAX_ERROR_RATE, alignment)
     else:
         transitions, emissions = build_profile_hmm_for_repeats(patterns, settings.MAX_ERROR_RATE)
     matches = [m for m in emissions.keys() if m.startswith('M')]
-
-    last_end = None
+    length = len(matches)
+    unit_size = 3 * length + 3
+
+    # Every copy emits with the same distributions, so they are created once and shared by all units
+    unit_distributions = [DiscreteDistribution(emissions['I%s' % i]) for i in range(length + 1)]
+    unit_distributions += [DiscreteDistribution(emissions['M%s' % i]) for i in range(1, length + 1)]
+    unit_distributions += [None for _ in range(length + 2)]
+    state_names = []
+    distributions = []
     for repeat in range(copies):
-        insert_states = []
-        match_states = []
-        delete_states = []
-        for i in range(len(matches) + 1):
-            insert_distribution = DiscreteDistribution(emissions['I%s' % i])
-            insert_states.append(State(insert_distribution, name='I%s_%s' % (i, repeat)))
-
-        for i in range(1, len(matches) + 1):
-            match_distribution = DiscreteDistribution(emissions['M%s' % i])
-            match_states.append(State(match_distribution, name='M%s_%s' % (str(i), repeat)))
-
-        for i in range(1, len(matches) + 1):
-            delete_states.append(State(None, name='D%s_%s' % (str(i), repeat)))
-
-        unit_start = State(None, name='unit_start_%s' % repeat)
-        unit_end = State(None, name='unit_end_%s' % repeat)
-        model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
-        n = len(delete_states)-1
-
-        if repeat > 0:
-            model.add_transition(last_end, unit_start, 1)
-        else:
-            model.add_transition(model.start, unit_start, 1)
-
-        if repeat == copies - 1:
-            model.add_transition(unit_end, model.end, 1)
-
-        model.add_transition(unit_start, match_states[0], transitions['unit_start']['M1'])
-        model.add_transition(unit_start, delete_states[0], transitions['unit_start']['D1'])
-        model.add_transition(unit_start, insert_states[0], transitions['unit_start']['I0'])
-
-        model.add_transition(insert_states[0], insert_states[0], transitions['I0']['I0'])
-        model.add_transition(insert_states[0], delete_states[0], transitions['I0']['D1'])
-        model.add_transition(insert_states[0], match_states[0], transitions['I0']['M1'])
-
-        model.add_transition(delete_states[n], unit_end, transitions['D%s' % (n+1)]['unit_end'])
-        model.add_transition(delete_states[n], insert_states[n+1], transitions['D%s' % (n+1)]['I%s' % (n+1)])
-
-        model.add_transition(match_states[n], unit_end, transitions['M%s' % (n+1)]['unit_end'])
-        model.add_transition(match_states[n], insert_states[n+1], transitions['M%s' % (n+1)]['I%s' % (n+1)])
-
-        model.add_transition(insert_states[n+1], insert_states[n+1], transitions['I%s' % (n+1)]['I%s' % (n+1)])
-        model.add_transition(insert_states[n+1], unit_end, transitions['I%s' % (n+1)]['unit_end'])
-
-        for i in range(1, len(matches)+1):
-            model.add_transition(match_states[i-1], insert_states[i], transitions['M%s' % i]['I%s' % i])
-            model.add_transition(delete_states[i-1], insert_states[i], transitions['D%s' % i]['I%s' % i])
-            model.add_transition(insert_states[i], insert_states[i], transitions['I%s' % i]['I%s' % i])
-            if i < len(matches):
-                model.add_transition(insert_states[i], match_states[i], transitions['I%s' % i]['M%s' % (i+1)])
-                model.add_transition(insert_states[i], delete_states[i], transitions['I%s' % i]['D%s' % (i+1)])
-
-                model.add_transition(match_states[i-1], match_states[i], transitions['M%s' % i]['M%s' % (i+1)])
-                model.add_transition(match_states[i-1], delete_states[i], transitions['M%s' % i]['D%s' % (i+1)])
-
-                model.add_transition(delete_states[i-1], match_states[i], transitions['D%s' % i]['M%s' % (i+1)])
-                model.add_transition(delete_states[i-1], delete_states[i], transitions['D%s' % i]['D%s' % (i+1)])
-
-        last_end = unit_end
-
-    model.bake(merge=None)
-    return model
+        distributions += unit_distributions
+        state_names += get_profile_unit_state_names(length, repeat)
+        state_names += ['unit_start_%s' % repeat, 'unit_end_%s' % repeat]
+
+    states_count = unit_size * copies
+    mat = np.zeros((states_count, states_count))
+    rows, columns, probabilities = get_profile_unit_transitions(length, lambda a, b: transitions[a][b])
+    bases = np.arange(copies) * unit_size
+    mat[np.add.outer(bases, rows), np.add.outer(bases, columns)] = probabilities
+    unit_starts = bases + 3 * length + 1
+    unit_ends = bases + 3 * length + 2
+    mat[unit_ends[:-1], unit_starts[1:]] = 1
+
+    starts = np.zeros(states_count)
+    starts[unit_starts[0]] = 1.0
+    ends = np.zeros(states_count)
+    ends[unit_ends[-1]] = 1.0
+    return build_model_from_matrix("Repeating Pattern Matcher HMM Model", mat, distributions, state_names, starts,
+                                   ends, merge=None)
 
 
 @time_usage
@@ -510,171 +502,163 @@ def get_variable_number_of_repeats_matcher_hmm(patterns, copies=1, vpaths=None):
     states_count = len(mat)
     start_repeats_ind = states_count
     end_repeats_ind = states_count + 1
-    mat = np.c_[mat, np.zeros(states_count), np.zeros(states_count)]
-    mat = np.r_[mat, [np.zeros(states_count + 2)]]
-    mat = np.r_[mat, [np.zeros(states_count + 2)]]
-
-    unit_ends = []
-    for i, state in enumerate(model.states):
-        if state.name.startswith('unit_end'):
-            unit_ends.append(i)
-
-    first_unit_start = None
-    for i in range(len(mat[model.start_index])):
-        if mat[model.start_index][i] != 0:
-            first_unit_start = i
+    padded_mat = np.zeros((states_count + 2, states_count + 2))
+    padded_mat[:states_count, :states_count] = mat
+    mat = padded_mat
+
+    state_names = np.array([state.name for state in states])
+    unit_ends = np.flatnonzero(np.char.startswith(state_names, 'unit_end'))
+    first_unit_start = np.flatnonzero(mat[model.start_index])[-1]
     mat[model.start_index][first_unit_start] = 0.0
     mat[model.start_index][start_repeats_ind] = 1
     mat[start_repeats_ind][first_unit_start] = 1
 
-    for unit_end in unit_ends:
-        next_state = None
-        for j in range(len(mat[unit_end])):
-            if mat[unit_end][j] != 0:
-                next_state = j
-        mat[unit_end][next_state] = 0.5
-        mat[unit_end][end_repeats_ind] = 0.5
+    next_states = mat.shape[1] - 1 - np.argmax(mat[unit_ends, ::-1] != 0, axis=1)
+    mat[unit_ends, next_states] = 0.5
+    mat[unit_ends, end_repeats_ind] = 0.5
 
     mat[end_repeats_ind][model.end_index] = 1
 
     starts = np.zeros(states_count + 2)
     starts[model.start_index] = 1.0
+    # Model.from_matrix used to connect the last state, end_repeating_pattern_match, to the end of the model
     ends = np.zeros(states_count + 2)
-    ends[model.end_index] = 1.0
-    state_names = [state.name for state in states]
+    ends[end_repeats_ind] = 1.0
+    state_names = state_names.tolist()
     distributions = [state.distribution for state in states]
     name = 'Repeat Matcher HMM Model'
-    new_model = Model.from_matrix(mat, distributions, starts, ends, name=name, state_names=state_names, merge=None)
-    new_model.bake(merge=None)
-    return new_model
+    return build_model_from_matrix(name, mat, distributions, state_names, starts, ends, merge=None)
+
+
+def save_model_arrays(model, file_name):
+    """Store the states, emissions and transitions of a baked model as arrays in a .npz file.
+
+    Loading them with load_model_arrays is much faster than parsing the pomegranate JSON of the model.
+    """
+    states = model.states
+    silent = np.array([state.distribution is None for state in states], dtype=bool)
+    alphabet = sorted(states[np.flatnonzero(~silent)[0]].distribution.parameters[0].keys())
+    emissions = np.zeros((len(states), len(alphabet)))
+    for i in np.flatnonzero(~silent):
+        parameters = states[i].distribution.parameters[0]
+        emissions[i] = [parameters[symbol] for symbol in alphabet]
+    mat = model.dense_transition_matrix()
+    rows, columns = np.nonzero(mat)
+    with open(file_name, 'wb') as output_file:
+        np.savez(output_file, name=model.name, state_names=[state.name for state in states], silent=silent,
+                 alphabet=alphabet, emissions=emissions, rows=rows, columns=columns, probabilities=mat[rows, columns],
+                 start_index=model.start_index, end_index=model.end_index)
+
+
+def load_model_arrays(file_name):
+    data = np.load(file_name)
+    alphabet = data['alphabet'].tolist()
+    emissions = data['emissions'].tolist()
+    states = []
+    for i, (state_name, silent) in enumerate(zip(data['state_names'].tolist(), data['silent'].tolist())):
+        distribution = None if silent else DiscreteDistribution(dict(zip(alphabet, emissions[i])))
+        states.append(State(distribution, name=state_name))
+    start_index = int(data['start_index'])
+    end_index = int(data['end_index'])
+    model = Model(name=str(data['name']), start=states[start_index], end=states[end_index])
+    model.add_states([state for i, state in enumerate(states) if i != start_index and i != end_index])
+    model.add_transitions([states[i] for i in data['rows']], [states[j] for j in data['columns']],
+                          data['probabilities'].tolist())
+    model.bake(merge=None)
+    return model
+
+
+def get_concatenated_model(models):
+    """Join the models one after another like Model.concatenate does, but into a new model.
+
+    The given models are left unchanged, so cached ones can be reused.
+    """
+    model = Model(name=models[0].name, start=models[0].start, end=models[-1].end)
+    model.graph = networkx.union_all([m.graph for m in models])
+    for previous_model, next_model in zip(models[:-1], models[1:]):
+        model.add_transition(previous_model.end, next_model.start, 1.00)
+    model.bake(merge=None)
+    return model
 
 
 @time_usage
 def get_read_matcher_model(left_flanking_region, right_flanking_region, patterns, copies=1, vpaths=None):
-    model = get_suffix_matcher_hmm(left_flanking_region)
+    left_flanking_matcher = get_suffix_matcher_hmm(left_flanking_region)
     repeats_matcher = get_variable_number_of_repeats_matcher_hmm(patterns, copies, vpaths)
     right_flanking_matcher = get_prefix_matcher_hmm(right_flanking_region)
-    model.concatenate(repeats_matcher)
-    model.concatenate(right_flanking_matcher)
-    model.bake(merge=None)
+    model = get_concatenated_model([left_flanking_matcher, repeats_matcher, right_flanking_matcher])
 
     mat = model.dense_transition_matrix()
 
-    first_repeat_matches = []
-    repeat_match_states = []
-    suffix_start = None
-    for i, state in enumerate(model.states):
-        if state.name[0] == 'M' and state.name.split('_')[-1] == '0':
-            first_repeat_matches.append(i)
-        if state.name[0] == 'M' and state.name.split('_')[-1] not in ['prefix', 'suffix']:
-            repeat_match_states.append(i)
-        if state.name == 'suffix_start_suffix':
-            suffix_start = i
+    state_names = np.array([state.name for state in model.states])
+    match_states = np.char.startswith(state_names, 'M')
+    hmm_names = np.char.rpartition(state_names, '_')[:, 2]
+    first_repeat_matches = np.flatnonzero(match_states & (hmm_names == '0'))
+    repeat_match_states = np.flatnonzero(match_states & (hmm_names != 'prefix') & (hmm_names != 'suffix'))
+    suffix_start = np.flatnonzero(state_names == 'suffix_start_suffix')[-1]
 
     mat[model.start_index][suffix_start] = 0.3
-    for first_repeat_match in first_repeat_matches:
-        mat[model.start_index][first_repeat_match] = 0.7 / len(first_repeat_matches)
+    mat[model.start_index, first_repeat_matches] = 0.7 / len(first_repeat_matches)
 
-    for match_state in repeat_match_states:
-        to_end = 0.7 / len(repeat_match_states)
-        total = 1 + to_end
-        for next_state in range(len(mat[match_state])):
-            if mat[match_state][next_state] != 0:
-                mat[match_state][next_state] /= total
-        mat[match_state][model.end_index] = to_end / total
+    to_end = 0.7 / len(repeat_match_states)
+    total = 1 + to_end
+    mat[repeat_match_states] /= total
+    mat[repeat_match_states, model.end_index] = to_end / total
 
     starts = np.zeros(len(model.states))
     starts[model.start_index] = 1.0
     ends = np.zeros(len(model.states))
     ends[model.end_index] = 1.0
-    state_names = [state.name for state in model.states]
+    state_names = state_names.tolist()
     distributions = [state.distribution for state in model.states]
     name = 'Read Matcher'
-    new_model = Model.from_matrix(mat, distributions, starts, ends, name=name, state_names=state_names, merge=None)
-    new_model.bake(merge=None)
-    return new_model
+    return build_model_from_matrix(name, mat, distributions, state_names, starts, ends, merge=None)
 
 
 def build_reference_repeat_finder_hmm(patterns, copies=1):
     pattern = patterns[0]
-    model = Model(name="HMM Model")
+    length = len(pattern)
+    unit_size = 3 * length + 3
     insert_distribution = DiscreteDistribution({'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25})
 
-    last_end = None
-    start_random_matches = State(insert_distribution, name='start_random_matches')
-    end_random_matches = State(insert_distribution, name='end_random_matches')
-    model.add_states([start_random_matches, end_random_matches])
-    for repeat in range(copies):
-        insert_states = []
-        match_states = []
-        delete_states = []
-        for i in range(len(pattern) + 1):
-            insert_states.append(State(insert_distribution, name='I%s_%s' % (i, repeat)))
-
-        for i in range(len(pattern)):
-            distribution_map = dict({'A': 0.01, 'C': 0.01, 'G': 0.01, 'T': 0.01})
-            distribution_map[pattern[i]] = 0.97
-            match_states.append(State(DiscreteDistribution(distribution_map), name='M%s_%s' % (str(i + 1), repeat)))
-
-        for i in range(len(pattern)):
-            delete_states.append(State(None, name='D%s_%s' % (str(i + 1), repeat)))
-
-        unit_start = State(None, name='unit_start_%s' % repeat)
-        unit_end = State(None, name='unit_end_%s' % repeat)
-        model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
-        last = len(delete_states)-1
-
-        if repeat > 0:
-            model.add_transition(last_end, unit_start, 0.5)
-        else:
-            model.add_transition(model.start, unit_start, 0.5)
-            model.add_transition(model.start, start_random_matches, 0.5)
-            model.add_transition(start_random_matches, unit_start, 0.5)
-            model.add_transition(start_random_matches, start_random_matches, 0.5)
-
-        model.add_transition(unit_end, end_random_matches, 0.5)
-        if repeat == copies - 1:
-            model.add_transition(unit_end, model.end, 0.5)
-            model.add_transition(end_random_matches, end_random_matches, 0.5)
-            model.add_transition(end_random_matches, model.end, 0.5)
-
-        model.add_transition(unit_start, match_states[0], 0.98)
-        model.add_transition(unit_start, delete_states[0], 0.01)
-        model.add_transition(unit_start, insert_states[0], 0.01)
-
-        model.add_transition(insert_states[0], insert_states[0], 0.01)
-        model.add_transition(insert_states[0], delete_states[0], 0.01)
-        model.add_transition(insert_states[0], match_states[0], 0.98)
-
-        model.add_transition(delete_states[last], unit_end, 0.99)
-        model.add_transition(delete_states[last], insert_states[last+1], 0.01)
-
-        model.add_transition(match_states[last], unit_end, 0.99)
-        model.add_transition(match_states[last], insert_states[last+1], 0.01)
-
-        model.add_transition(insert_states[last+1], insert_states[last+1], 0.01)
-        model.add_transition(insert_states[last+1], unit_end, 0.99)
-
-        for i in range(0, len(pattern)):
-            model.add_transition(match_states[i], insert_states[i+1], 0.01)
-            model.add_transition(delete_states[i], insert_states[i+1], 0.01)
-            model.add_transition(insert_states[i+1], insert_states[i+1], 0.01)
-            if i < len(pattern) - 1:
-                model.add_transition(insert_states[i+1], match_states[i+1], 0.98)
-                model.add_transition(insert_states[i+1], delete_states[i+1], 0.01)
-
-                model.add_transition(match_states[i], match_states[i+1], 0.98)
-                model.add_transition(match_states[i], delete_states[i+1], 0.01)
-
-                model.add_transition(delete_states[i], delete_states[i+1], 0.01)
-                model.add_transition(delete_states[i], match_states[i+1], 0.98)
-
-        last_end = unit_end
-
-    model.bake()
-    if len(patterns) > 1:
-        # model.fit(patterns, algorithm='baum-welch', transition_pseudocount=1, use_pseudocount=True)
-        fit_patterns = [pattern * copies for pattern in patterns]
-        #model.fit(fit_patterns, algorithm='viterbi', transition_pseudocount=1, use_pseudocount=True)
+    unit_distributions = [insert_distribution for _ in range(length + 1)]
+    for i in range(length):
+        unit_distributions.append(DiscreteDistribution(get_match_emission(pattern[i])))
+    unit_distributions += [None for _ in range(length + 2)]
 
-    return model
+    state_names = ['start_random_matches', 'end_random_matches']
+    distributions = [insert_distribution, insert_distribution]
+    for repeat in range(copies):
+        distributions += unit_distributions
+        state_names += get_profile_unit_state_names(length, repeat)
+        state_names += ['unit_start_%s' % repeat, 'unit_end_%s' % repeat]
+
+    def transition(a, b):
+        if b.startswith('M'):
+            return 0.98
+        if b == 'unit_end':
+            return 0.99
+        return 0.01
+
+    states_count = len(state_names)
+    start_random_matches = 0
+    end_random_matches = 1
+    mat = np.zeros((states_count, states_count))
+    rows, columns, probabilities = get_profile_unit_transitions(length, transition)
+    bases = 2 + np.arange(copies) * unit_size
+    mat[np.add.outer(bases, rows), np.add.outer(bases, columns)] = probabilities
+    unit_starts = bases + 3 * length + 1
+    unit_ends = bases + 3 * length + 2
+    mat[unit_ends[:-1], unit_starts[1:]] = 0.5
+    mat[unit_ends, end_random_matches] = 0.5
+    mat[start_random_matches, unit_starts[0]] = 0.5
+    mat[start_random_matches, start_random_matches] = 0.5
+    mat[end_random_matches, end_random_matches] = 0.5
+
+    starts = np.zeros(states_count)
+    starts[unit_starts[0]] = 0.5
+    starts[start_random_matches] = 0.5
+    ends = np.zeros(states_count)
+    ends[unit_ends[-1]] = 0.5
+    ends[end_random_matches] = 0.5
+    return build_model_from_matrix("HMM Model", mat, distributions, state_names, starts, ends, merge='All')
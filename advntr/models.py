@@ -67,11 +67,11 @@ def find_non_overlapping_vntrs(manager, vntrs, result, index, chrom=None, output
                 j += 1
     with lock:
         print('writing %s for %s' % (len(vntrs), chrom))
-        for vntr in vntrs:
-            if not vntr.is_non_overlapping():
-                continue
-            repeat_segments = ','.join(vntr.get_repeat_segments())
-            with open(output_file, 'a') as out:
+        with open(output_file, 'a') as out:
+            for vntr in vntrs:
+                if not vntr.is_non_overlapping():
+                    continue
+                repeat_segments = ','.join(vntr.get_repeat_segments())
                 end_point = vntr.start_point + vntr.get_length()
                 gene_name, annotation = None, None
                 out.write('%s %s %s %s %s %s %s %s %s %s\n' % (vntr.id, vntr.is_non_overlapping(), vntr.chromosome,
@@ -311,15 +311,15 @@ def identify_similar_regions_for_vntrs_using_blat():
 def extend_flanking_regions_in_processed_vntrs(flanking_size=500, output_file='vntr_data/repeats_and_segments2.txt'):
     vntrs = load_unique_vntrs_data()
     reference_genomes = {}
-    for vntr in vntrs:
-        comma_separated_segments = ','.join(vntr.get_repeat_segments())
-        if vntr.chromosome not in reference_genomes.keys():
-            reference_genomes[vntr.chromosome] = get_chromosome_reference_sequence(vntr.chromosome)
-        start = vntr.start_point
-        left_flanking_region = reference_genomes[vntr.chromosome][start-flanking_size:start].upper()
-        end = vntr.start_point + vntr.get_length()
-        right_flanking_region = reference_genomes[vntr.chromosome][end:end+flanking_size].upper()
-        with open(output_file, 'a') as out:
+    with open(output_file, 'a') as out:
+        for vntr in vntrs:
+            comma_separated_segments = ','.join(vntr.get_repeat_segments())
+            if vntr.chromosome not in reference_genomes:
+                reference_genomes[vntr.chromosome] = get_chromosome_reference_sequence(vntr.chromosome)
+            start = vntr.start_point
+            left_flanking_region = reference_genomes[vntr.chromosome][start-flanking_size:start].upper()
+            end = vntr.start_point + vntr.get_length()
+            right_flanking_region = reference_genomes[vntr.chromosome][end:end+flanking_size].upper()
             out.write('%s %s %s %s %s\n' % (vntr.id, vntr.is_non_overlapping(), left_flanking_region,
                                             right_flanking_region, comma_separated_segments))
 
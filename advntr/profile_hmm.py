@@ -153,10 +153,10 @@ def build_profile_hmm_pseudocounts_for_alignment(error_rate, alignment):
         index_list.extend(['M'+str(i), 'D'+str(i), 'I'+str(i)])
     index_list.append('unit_end')
     for key1 in index_list:
-        if key1 not in transition.keys():
+        if key1 not in transition:
             transition[key1] = {}
         for key2 in index_list:
-            if key2 not in transition[key1].keys():
+            if key2 not in transition[key1]:
                 transition[key1][key2] = 0
     return transition, emission
 
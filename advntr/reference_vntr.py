@@ -1,6 +1,7 @@
 from Bio import pairwise2
 
-from advntr.hmm_utils import build_reference_repeat_finder_hmm, get_repeat_segments_from_visited_states_and_region
+from advntr.hmm_utils import build_reference_repeat_finder_hmm, get_repeat_segments_from_visited_states_and_region, \
+    get_vpath_summary
 from advntr.utils import get_chromosome_reference_sequence
 
 
@@ -41,11 +42,14 @@ class ReferenceVNTR:
                 self.scaled_score == other.scaled_score)
 
     def init_from_vntrseek_data(self):
-        corresponding_region_in_ref = self.get_corresponding_region_in_ref()
+        # The chromosome is loaded once for both the repeats and the flanking regions
+        ref_sequence = self.__get_chromosome_reference_sequence()
+        corresponding_region_in_ref = self.get_corresponding_region_in_ref(ref_sequence)
         repeat_segments = self.find_repeat_segments(corresponding_region_in_ref)
         self.repeat_segments = repeat_segments
         flanking_region_size = 500
-        self.left_flanking_region, self.right_flanking_region = self.get_flanking_regions(flanking_region_size)
+        self.left_flanking_region, self.right_flanking_region = self.get_flanking_regions(flanking_region_size,
+                                                                                          ref_sequence)
         self.chromosome_sequence = None
 
     def init_from_xml(self, repeat_segments, left_flanking_region, right_flanking_region):
@@ -81,8 +85,7 @@ class ReferenceVNTR:
         patterns = [self.pattern]
         model = build_reference_repeat_finder_hmm(patterns, copies=self.estimated_repeats)
         logp, path = model.viterbi(region_in_ref)
-        visited_states = [state.name for idx, state in path[1:-1]]
-        repeat_segments = get_repeat_segments_from_visited_states_and_region(visited_states, region_in_ref)
+        repeat_segments = get_repeat_segments_from_visited_states_and_region(get_vpath_summary(path), region_in_ref)
 
         return repeat_segments
 
@@ -91,8 +94,9 @@ class ReferenceVNTR:
             return self.chromosome_sequence
         return get_chromosome_reference_sequence(self.chromosome)
 
-    def get_corresponding_region_in_ref(self):
-        ref_sequence = self.__get_chromosome_reference_sequence()
+    def get_corresponding_region_in_ref(self, ref_sequence=None):
+        if ref_sequence is None:
+            ref_sequence = self.__get_chromosome_reference_sequence()
         estimated_length = int(len(self.pattern) * self.estimated_repeats)
         corresponding_region_in_ref = ref_sequence[self.start_point:self.start_point + estimated_length].upper()
         while corresponding_region_in_ref.find('N') != -1:
@@ -100,8 +104,9 @@ class ReferenceVNTR:
             corresponding_region_in_ref = corresponding_region_in_ref[:n_index]
         return corresponding_region_in_ref
 
-    def get_flanking_regions(self, flanking_region_size=140):
-        ref_sequence = self.__get_chromosome_reference_sequence()
+    def get_flanking_regions(self, flanking_region_size=140, ref_sequence=None):
+        if ref_sequence is None:
+            ref_sequence = self.__get_chromosome_reference_sequence()
         left_flanking = ref_sequence[self.start_point - flanking_region_size:self.start_point].upper()
         end_of_repeats = self.start_point + self.get_length()
         right_flanking = ref_sequence[end_of_repeats:end_of_repeats + flanking_region_size].upper()
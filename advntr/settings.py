@@ -27,6 +27,10 @@ MAPQ_CUTOFF = 0
 
 MAX_ERROR_RATE = 0.05
 
+# Skip viterbi on strands of unmapped reads that share no k-mer with the VNTR. Faster, but reads made only of repeats
+# with dense errors are not recruited.
+PRESCREEN_UNMAPPED_READ_STRANDS = True
+
 hostname = socket.gethostname()
 if hostname.startswith('genome'):
     CORES = 20
@@ -1,14 +1,23 @@
 import logging
 
-from Bio import SeqIO
-
 from advntr.settings import *
 
+try:
+    from string import maketrans
+except ImportError:
+    maketrans = str.maketrans
+
+DNA_COMPLEMENT = maketrans('ACGTMRWSYKVHDBNacgtmrwsykvhdbn', 'TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
+
 
 def get_min_number_of_copies_to_span_read(pattern, read_length=150):
     return int(round(float(read_length) / len(pattern) + 0.499))
 
 
+def get_reverse_complement(sequence):
+    return sequence.translate(DNA_COMPLEMENT)[::-1]
+
+
 def get_gc_content(s):
     res = 0
     for e in s:
@@ -38,14 +47,33 @@ def is_low_quality_read(read):
     return False
 
 
+def read_fasta_sequences(file_name, names=None):
+    """Yield (id, sequence) for records of a FASTA file, like SeqIO.parse without building SeqRecords.
+
+    When names is given, other records are skipped without keeping their sequence in memory.
+    """
+    with open(file_name) as input_file:
+        name = None
+        lines = None
+        for line in input_file:
+            if line.startswith('>'):
+                if lines is not None:
+                    yield name, ''.join(lines).replace('\n', '').replace('\r', '').replace(' ', '')
+                header = line[1:].split(None, 1)
+                name = header[0] if header else ''
+                lines = [] if names is None or name in names else None
+            elif lines is not None:
+                lines.append(line)
+        if lines is not None:
+            yield name, ''.join(lines).replace('\n', '').replace('\r', '').replace(' ', '')
+
+
 def get_chromosome_reference_sequence(chromosome):
     ref_file_name = HG19_DIR + chromosome + '.fa'
     ref_file_name = 'hg38_chromosomes/hg38.fa'
 #    ref_file_name = '/tmp/hg38.fa'
-    fasta_sequences = SeqIO.parse(open(ref_file_name), 'fasta')
     ref_sequence = ''
-    for fasta in fasta_sequences:
-        if chromosome == fasta.id:
-            name, ref_sequence = fasta.id, str(fasta.seq)
-            break
+    for name, sequence in read_fasta_sequences(ref_file_name, names=(chromosome,)):
+        ref_sequence = sequence
+        break
     return ref_sequence
@@ -1,17 +1,15 @@
-from collections import Counter
+from collections import Counter, defaultdict
 import logging
 import numpy
 import os
-from multiprocessing import Process, Manager, Value, Semaphore
-from random import random
+from multiprocessing import Value, Pool
+from multiprocessing.pool import ThreadPool
 
 from keras.models import Sequential, load_model
 import pysam
 from enum import Enum
 
 from Bio import pairwise2
-from Bio.Seq import Seq
-from Bio import SeqIO
 
 from advntr.coverage_bias import CoverageBiasDetector, CoverageCorrector
 from advntr.deep_recruitment import get_embedding_of_string, input_dim
@@ -20,7 +18,7 @@ from advntr.pacbio_haplotyper import PacBioHaplotyper
 from advntr.profiler import time_usage
 from advntr.sam_utils import get_reference_genome_of_alignment_file, get_related_reads_and_read_count_in_samfile
 from advntr import settings
-from advntr.utils import is_low_quality_read
+from advntr.utils import get_reverse_complement, is_low_quality_read, read_fasta_sequences
 from pomegranate import HiddenMarkovModel as Model
 
 
@@ -44,10 +42,15 @@ class LoggedRead:
 
 
 class SelectedRead:
-    def __init__(self, sequence, logp, vpath, mapq=None, reference_start=None, query_name=None):
+    def __init__(self, sequence, logp, vpath, mapq=None, reference_start=None, query_name=None, vpath_summary=None,
+                 repeat_bps=None):
         self.sequence = sequence
         self.logp = logp
         self.vpath = vpath
+        self.vpath_summary = vpath_summary if vpath_summary is not None else get_vpath_summary(vpath)
+        if repeat_bps is None:
+            repeat_bps = get_number_of_repeat_bp_matches_in_vpath(self.vpath_summary)
+        self.repeat_bps = repeat_bps
         self.mapq = mapq
         self.is_mapped = reference_start is not None
         self.query_name = query_name
@@ -56,6 +59,67 @@ class SelectedRead:
         return self.is_mapped
 
 
+# Per-process state of the workers that run viterbi on unmapped reads, set by init_unmapped_read_worker
+UNMAPPED_READ_WORKER = {}
+
+
+def init_unmapped_read_worker(vntr_finder, hmm, recruitment_score, prescreen_strands):
+    UNMAPPED_READ_WORKER['vntr_finder'] = vntr_finder
+    UNMAPPED_READ_WORKER['hmm'] = hmm
+    UNMAPPED_READ_WORKER['hmm_summary'] = get_model_state_summary(hmm)
+    UNMAPPED_READ_WORKER['recruitment_score'] = recruitment_score
+    UNMAPPED_READ_WORKER['prescreen_strands'] = prescreen_strands
+
+
+def recruit_unmapped_read_in_worker(read_segment):
+    vntr_finder = UNMAPPED_READ_WORKER['vntr_finder']
+    recruited = vntr_finder.recruit_unmapped_read(read_segment, UNMAPPED_READ_WORKER['hmm'],
+                                                  UNMAPPED_READ_WORKER['recruitment_score'],
+                                                  prescreen_strands=UNMAPPED_READ_WORKER['prescreen_strands'],
+                                                  hmm_summary=UNMAPPED_READ_WORKER['hmm_summary'])
+    if recruited is None:
+        return None
+    sequence, logp, vpath, vpath_summary, repeat_bps = recruited
+    # States are sent back by index and mapped to the states of the model in the parent process
+    return sequence, logp, [idx for idx, state in vpath], vpath_summary, repeat_bps
+
+
+def run_viterbi_on_sequences(hmm, sequences):
+    """Return hmm.viterbi of each sequence, decoding them in threads that share the model when there are cores.
+
+    Viterbi releases the GIL, so the threads run in parallel without copying the model to other processes. Each
+    thread holds its own viterbi matrix, so this is meant for short reads only.
+    """
+    if settings.CORES < 2 or len(sequences) < 2:
+        return [hmm.viterbi(sequence) for sequence in sequences]
+    pool = ThreadPool(min(settings.CORES, len(sequences)))
+    try:
+        return pool.map(hmm.viterbi, sequences)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Per-process state of the workers that process pacbio reads, set by init_pacbio_read_worker
+PACBIO_READ_WORKER = {}
+
+
+def init_pacbio_read_worker(vntr_finder):
+    PACBIO_READ_WORKER['vntr_finder'] = vntr_finder
+
+
+def get_spanning_region_of_mapped_pacbio_read_in_worker(mapped_read):
+    read_id, sequence, reference_positions = mapped_read
+    vntr_finder = PACBIO_READ_WORKER['vntr_finder']
+    return vntr_finder.get_spanning_region_of_mapped_pacbio_read(read_id, sequence, reference_positions)
+
+
+def get_spanning_regions_of_unaligned_pacbio_read_in_worker(unaligned_read):
+    read_id, sequence = unaligned_read
+    vntr_finder = PACBIO_READ_WORKER['vntr_finder']
+    return vntr_finder.get_spanning_regions_of_unaligned_pacbio_read(read_id, sequence)
+
+
 class VNTRFinder:
     """Find the VNTR structure of a reference VNTR in NGS data of the donor."""
 
@@ -74,6 +138,7 @@ class VNTRFinder:
 
         self.vntr_start = self.reference_vntr.start_point
         self.vntr_end = self.vntr_start + self.reference_vntr.get_length()
+        self.strand_kmers = None
 
     def get_unique_left_flank(self):
         patterns = self.reference_vntr.get_repeat_segments()[0] * 10
@@ -121,20 +186,21 @@ class VNTRFinder:
         logging.info('Using read length %s' % read_length)
         copies = self.get_copies_for_hmm(read_length)
 
-        base_name = str(self.reference_vntr.id) + '_' + str(read_length) + '.json'
-        stored_hmm_file = settings.TRAINED_HMMS_DIR + base_name
+        base_name = str(self.reference_vntr.id) + '_' + str(read_length)
+        stored_hmm_file = settings.TRAINED_HMMS_DIR + base_name + '.npz'
+        stored_json_hmm_file = settings.TRAINED_HMMS_DIR + base_name + '.json'
         if settings.USE_TRAINED_HMMS and os.path.isfile(stored_hmm_file):
+            return load_model_arrays(stored_hmm_file)
+        if settings.USE_TRAINED_HMMS and os.path.isfile(stored_json_hmm_file):
             model = Model()
-            model = model.from_json(stored_hmm_file)
+            model = model.from_json(stored_json_hmm_file)
             return model
 
         flanking_region_size = read_length
         vntr_matcher = self.build_vntr_matcher_hmm(copies, flanking_region_size)
 
         if settings.USE_TRAINED_HMMS:
-            json_str = vntr_matcher.to_json()
-            with open(stored_hmm_file, 'w') as outfile:
-                outfile.write(json_str)
+            save_model_arrays(vntr_matcher, stored_hmm_file)
         return vntr_matcher
 
     def get_keywords_for_filtering(self, short_reads=True, keyword_size=21):
@@ -153,10 +219,30 @@ class VNTRFinder:
         queries = set(queries)
         return queries
 
+    def get_strand_kmer_hits(self, sequence, kmer_size=11):
+        """Return how many k-mers of sequence and of its reverse complement occur in the VNTR locus."""
+        if self.strand_kmers is None:
+            locus = self.reference_vntr.left_flanking_region + ''.join(self.reference_vntr.get_repeat_segments()) + \
+                    self.reference_vntr.right_flanking_region
+            locus = locus.upper()
+            kmers = set(locus[i:i + kmer_size] for i in range(len(locus) - kmer_size + 1))
+            reverse_kmers = set(get_reverse_complement(kmer) for kmer in kmers)
+            self.strand_kmers = kmers, reverse_kmers
+        kmers, reverse_kmers = self.strand_kmers
+        forward_hits = 0
+        reverse_hits = 0
+        for i in range(len(sequence) - kmer_size + 1):
+            kmer = sequence[i:i + kmer_size]
+            if kmer in kmers:
+                forward_hits += 1
+            if kmer in reverse_kmers:
+                reverse_hits += 1
+        return forward_hits, reverse_hits
+
     @staticmethod
     def add_hmm_score_to_list(sema, hmm, read, result_scores):
         logp, vpath = hmm.viterbi(str(read.seq))
-        rev_logp, rev_vpath = hmm.viterbi(str(Seq(str(read.seq)).reverse_complement()))
+        rev_logp, rev_vpath = hmm.viterbi(get_reverse_complement(str(read.seq)))
         if logp < rev_logp:
             logp = rev_logp
         result_scores.append(logp)
@@ -177,6 +263,7 @@ class VNTRFinder:
         return self.reference_vntr.scaled_score * read_length
 
     def recruit_read(self, logp, vpath, min_score_to_count_read, read_sequence):
+        vpath = get_vpath_summary(vpath)
         read_length = len(read_sequence)
         right_flank = self.reference_vntr.right_flanking_region
         left_flank = self.reference_vntr.left_flanking_region
@@ -190,9 +277,9 @@ class VNTRFinder:
         return False
 
     def process_unmapped_read_with_dnn(self, read_segment, hmm, recruitment_score, vntr_bp_in_unmapped_reads,
-                                       selected_reads, compute_reverse, dnn_model):
+                                       selected_reads, compute_reverse, dnn_model, hmm_summary=None):
         logging.info('process unmapped read with DNN')
-        if read_segment.count('N') <= 0:
+        if 'N' not in read_segment:
             sequence = read_segment.upper()
             reverse_sequence = ''
             forward_dnn_read = False
@@ -206,7 +293,7 @@ class VNTRFinder:
                 logging.info('%s and %s' % (selected[0], selected[1]))
                 forward_dnn_read = True
             if compute_reverse:
-                reverse_sequence = str(Seq(sequence).reverse_complement())
+                reverse_sequence = get_reverse_complement(sequence)
                 embedding = get_embedding_of_string(reverse_sequence)
                 selected = dnn_model.predict(numpy.array([embedding]), batch_size=1)[0]
                 if selected[0] > selected[1]:
@@ -225,34 +312,85 @@ class VNTRFinder:
                         vpath = rev_vpath
 
                 logging.info('this is a VNTR read')
-                repeat_bps = get_number_of_repeat_bp_matches_in_vpath(vpath)
-                if self.recruit_read(logp, vpath, recruitment_score, sequence):
+                vpath_summary = get_vpath_summary(vpath, hmm_summary)
+                repeat_bps = get_number_of_repeat_bp_matches_in_vpath(vpath_summary)
+                if self.recruit_read(logp, vpath_summary, recruitment_score, sequence):
                     if repeat_bps > self.min_repeat_bp_to_count_repeats:
                         vntr_bp_in_unmapped_reads.value += repeat_bps
                     if repeat_bps > self.min_repeat_bp_to_add_read:
-                        selected_reads.append(SelectedRead(sequence, logp, vpath))
+                        selected_reads.append(SelectedRead(sequence, logp, vpath, vpath_summary=vpath_summary,
+                                                           repeat_bps=repeat_bps))
 
-    def process_unmapped_read(self, sema, read_segment, hmm, recruitment_score, vntr_bp_in_unmapped_reads,
-                              selected_reads, compute_reverse=True):
-        if read_segment.count('N') <= 0:
-            sequence = read_segment.upper()
+    def recruit_unmapped_read(self, read_segment, hmm, recruitment_score, compute_reverse=True,
+                              prescreen_strands=True, hmm_summary=None):
+        """Return (sequence, logp, vpath, vpath_summary, repeat_bps) of the best strand if the read is recruited.
+
+        hmm_summary is the get_model_state_summary of hmm, if the caller keeps one for all of its reads.
+
+        With prescreen_strands, a strand that shares no 11-mer with the locus is not decoded. Both strands are
+        decoded whenever both share one, as k-mer counts do not bound the viterbi score. This trades recall for
+        speed: a read made only of repeats with dense errors can share no k-mer with the locus and still be
+        recruited by viterbi, but it is dropped here. Without it, both strands are always decoded.
+        """
+        if 'N' in read_segment:
+            return None
+        sequence = read_segment.upper()
+        if prescreen_strands:
+            forward_hits, reverse_hits = self.get_strand_kmer_hits(sequence)
+        else:
+            forward_hits, reverse_hits = 1, 1
+        if not compute_reverse:
+            reverse_hits = 0
+        if forward_hits == 0 and reverse_hits == 0:
+            return None
+        if forward_hits > 0:
             logp, vpath = hmm.viterbi(sequence)
-            if compute_reverse:
-                reverse_sequence = str(Seq(sequence).reverse_complement())
-                rev_logp, rev_vpath = hmm.viterbi(reverse_sequence)
-                if logp < rev_logp:
-                    sequence = reverse_sequence
-                    logp = rev_logp
-                    vpath = rev_vpath
-            repeat_bps = get_number_of_repeat_bp_matches_in_vpath(vpath)
-            if self.recruit_read(logp, vpath, recruitment_score, sequence):
-                if repeat_bps > self.min_repeat_bp_to_count_repeats:
-                    vntr_bp_in_unmapped_reads.value += repeat_bps
-                if repeat_bps > self.min_repeat_bp_to_add_read:
-                    selected_reads.append(SelectedRead(sequence, logp, vpath))
+        if reverse_hits > 0:
+            reverse_sequence = get_reverse_complement(sequence)
+            rev_logp, rev_vpath = hmm.viterbi(reverse_sequence)
+            if forward_hits == 0 or logp < rev_logp:
+                sequence = reverse_sequence
+                logp = rev_logp
+                vpath = rev_vpath
+        vpath_summary = get_vpath_summary(vpath, hmm_summary)
+        repeat_bps = get_number_of_repeat_bp_matches_in_vpath(vpath_summary)
+        if not self.recruit_read(logp, vpath_summary, recruitment_score, sequence):
+            return None
+        return sequence, logp, vpath, vpath_summary, repeat_bps
+
+    def add_recruited_unmapped_read(self, recruited, vntr_bp_in_unmapped_reads, selected_reads):
+        sequence, logp, vpath, vpath_summary, repeat_bps = recruited
+        if repeat_bps > self.min_repeat_bp_to_count_repeats:
+            vntr_bp_in_unmapped_reads.value += repeat_bps
+        if repeat_bps > self.min_repeat_bp_to_add_read:
+            selected_reads.append(SelectedRead(sequence, logp, vpath, vpath_summary=vpath_summary,
+                                               repeat_bps=repeat_bps))
+
+    def process_unmapped_read(self, sema, read_segment, hmm, recruitment_score, vntr_bp_in_unmapped_reads,
+                              selected_reads, compute_reverse=True, prescreen_strands=True, hmm_summary=None):
+        recruited = self.recruit_unmapped_read(read_segment, hmm, recruitment_score, compute_reverse,
+                                               prescreen_strands, hmm_summary)
+        if recruited is not None:
+            self.add_recruited_unmapped_read(recruited, vntr_bp_in_unmapped_reads, selected_reads)
         if sema is not None:
             sema.release()
 
+    def process_unmapped_reads_in_parallel(self, read_segments, hmm, recruitment_score, vntr_bp_in_unmapped_reads,
+                                           selected_reads, prescreen_strands=True):
+        pool = Pool(settings.CORES, initializer=init_unmapped_read_worker,
+                    initargs=(self, hmm, recruitment_score, prescreen_strands))
+        try:
+            for recruited in pool.imap(recruit_unmapped_read_in_worker, read_segments, chunksize=16):
+                if recruited is None:
+                    continue
+                sequence, logp, state_indices, vpath_summary, repeat_bps = recruited
+                vpath = [(idx, hmm.states[idx]) for idx in state_indices]
+                self.add_recruited_unmapped_read((sequence, logp, vpath, vpath_summary, repeat_bps),
+                                                 vntr_bp_in_unmapped_reads, selected_reads)
+        finally:
+            pool.close()
+            pool.join()
+
     def identify_frameshift(self, location_coverage, observed_indel_transitions, expected_indels, error_rate=0.01):
         if observed_indel_transitions >= location_coverage:
             return True
@@ -263,36 +401,38 @@ class VNTRFinder:
         return prob < 0.01
 
     def find_frameshift_from_selected_reads(self, selected_reads):
-        mutations = {}
+        mutations = defaultdict(int)
         repeating_bps_in_data = 0
         repeats_lengths_distribution = []
         for read in selected_reads:
-            visited_states = [state.name for idx, state in read.vpath[1:-1]]
-            repeats_lengths = get_repeating_pattern_lengths(visited_states)
+            summary = read.vpath_summary
+            visited_states = summary.visited_states
+            repeats_lengths = get_repeating_pattern_lengths(summary)
             repeats_lengths_distribution += repeats_lengths
-            current_repeat = None
-            repeating_bps_in_data += get_number_of_repeat_bp_matches_in_vpath(read.vpath)
-            for i in range(len(visited_states)):
-                if visited_states[i].endswith('fix') or visited_states[i].startswith('M'):
-                    continue
-                if visited_states[i].startswith('unit_start'):
-                    if current_repeat is None:
-                        current_repeat = 0
-                    else:
-                        current_repeat += 1
-                if current_repeat is None or current_repeat >= len(repeats_lengths):
-                    continue
-                if not visited_states[i].startswith('I') and not visited_states[i].startswith('D'):
-                    continue
-                if repeats_lengths[current_repeat] == len(self.reference_vntr.pattern):
+            emitted_basepairs = None
+            repeating_bps_in_data += read.repeat_bps
+            pattern_length = len(self.reference_vntr.pattern)
+            # Only repeats within two base pairs of the pattern length, but not equal to it, contribute mutations
+            if not any(0 < abs(length - pattern_length) <= 2 for length in repeats_lengths):
+                continue
+            # Match and flanking region states are ignored, and each unit start opens the next repeat
+            counted = ~(summary.is_match | summary.endswith_prefix | summary.endswith_suffix)
+            current_repeats = numpy.cumsum(summary.is_unit_start & counted) - 1
+            counted &= (current_repeats >= 0) & (current_repeats < len(repeats_lengths))
+            length_differences = numpy.zeros(len(summary), dtype=int)
+            repeats_lengths_array = numpy.array(repeats_lengths, dtype=int)
+            length_differences[counted] = repeats_lengths_array[current_repeats[counted]] - pattern_length
+            counted &= (length_differences != 0) & (numpy.abs(length_differences) <= 2)
+            for i in numpy.flatnonzero(counted):
+                state_name = visited_states[i]
+                if not state_name.startswith(('I', 'D')):
                     continue
-                state = visited_states[i].split('_')[0]
-                if state.startswith('I'):
-                    state += get_emitted_basepair_from_visited_states(visited_states[i], visited_states, read.sequence)
-                if abs(repeats_lengths[current_repeat] - len(self.reference_vntr.pattern)) <= 2:
-                    if state not in mutations.keys():
-                        mutations[state] = 0
-                    mutations[state] += 1
+                state = state_name.split('_')[0]
+                if state_name.startswith('I'):
+                    if emitted_basepairs is None:
+                        emitted_basepairs = get_emitted_basepairs_of_visited_states(visited_states, read.sequence)
+                    state += emitted_basepairs[state_name]
+                mutations[state] += 1
         sorted_mutations = sorted(mutations.items(), key=lambda x: x[1])
         logging.debug('sorted mutations: %s ' % sorted_mutations)
         frameshift_candidate = sorted_mutations[-1] if len(sorted_mutations) else (None, 0)
@@ -309,6 +449,7 @@ class VNTRFinder:
         return None
 
     def read_flanks_repeats_with_confidence(self, vpath, read_sequence):
+        vpath = get_vpath_summary(vpath)
         right_flank = self.reference_vntr.right_flanking_region
         left_flank = self.reference_vntr.left_flanking_region
         logging.debug('get_flanking_regions_matching_rate: accuracy filter T {} F {}'.format(
@@ -316,8 +457,9 @@ class VNTRFinder:
                 get_flanking_regions_matching_rate(vpath, read_sequence, left_flank, right_flank, accuracy_filter=False)))
         if get_flanking_regions_matching_rate(vpath, read_sequence, left_flank, right_flank) < 0.95:
             return False
-        if get_left_flanking_region_size_in_vpath(vpath) > self.minimum_left_flanking_size:
-            if get_right_flanking_region_size_in_vpath(vpath) > self.minimum_right_flanking_size:
+        left_flanking_size, right_flanking_size = get_flanking_region_sizes_in_vpath(vpath)
+        if left_flanking_size > self.minimum_left_flanking_size:
+            if right_flanking_size > self.minimum_right_flanking_size:
                 return True
         return False
 
@@ -364,13 +506,21 @@ class VNTRFinder:
                                          source=ReadSource.UNMAPPED))
         length_distribution.append(right_align[3] - (left_align[3] + flanking_region_size))
 
-    def check_if_pacbio_read_spans_vntr(self, sema, read, length_distribution, spanning_reads):
-        self.check_if_flanking_regions_align_to_str(str(read.seq).upper(), read.query_name, length_distribution, spanning_reads)
-        reverse_complement_str = str(Seq(str(read.seq)).reverse_complement())
-        self.check_if_flanking_regions_align_to_str(reverse_complement_str.upper(), read.query_name, length_distribution, spanning_reads)
-        sema.release()
+    def get_spanning_regions_of_unaligned_pacbio_read(self, read_id, sequence):
+        """Return the spanning reads and VNTR lengths found on both strands of an unaligned read."""
+        length_distribution = []
+        spanning_reads = []
+        self.check_if_flanking_regions_align_to_str(sequence.upper(), read_id, length_distribution, spanning_reads)
+        reverse_complement_str = get_reverse_complement(sequence).upper()
+        self.check_if_flanking_regions_align_to_str(reverse_complement_str, read_id, length_distribution, spanning_reads)
+        return spanning_reads, length_distribution
+
+    def get_spanning_region_of_mapped_pacbio_read(self, read_id, sequence, reference_positions):
+        """Return the part of a mapped read that spans the VNTR as a LoggedRead with its VNTR length, or None.
 
-    def check_if_pacbio_mapped_read_spans_vntr(self, sema, read, length_distribution, spanning_reads):
+        reference_positions are the aligned reference positions of all bases of the read, None for soft-clipped
+        and inserted bases.
+        """
         hmm_flanking_region_size = 100
         min_flanking_bp = 10
         vntr_start = self.reference_vntr.start_point
@@ -378,8 +528,9 @@ class VNTRFinder:
 
         region_start = vntr_start - hmm_flanking_region_size
 
-        first_aligned_position = read.get_reference_positions()[0]
-        last_aligned_position = read.get_reference_positions()[-1]
+        aligned_positions = [ref_pos for ref_pos in reference_positions if ref_pos is not None]
+        first_aligned_position = aligned_positions[0]
+        last_aligned_position = aligned_positions[-1]
         if first_aligned_position <= vntr_start - min_flanking_bp and vntr_end + min_flanking_bp < last_aligned_position:
             read_region_start = None
             read_region_end = None
@@ -387,7 +538,7 @@ class VNTRFinder:
             tr_spanning_bp = 0
             left_flanking_bp = 0
             right_flanking_bp = 0
-            for read_pos, ref_pos in enumerate(read.get_reference_positions(full_length=True)):
+            for read_pos, ref_pos in enumerate(reference_positions):
                 if ref_pos is None:  # soft-clip or insertions
                     continue
                 if ref_pos > vntr_end + hmm_flanking_region_size:  # Boundary check
@@ -406,45 +557,45 @@ class VNTRFinder:
                         right_flanking_bp += 1
 
             if left_flanking_bp < min_flanking_bp or right_flanking_bp < min_flanking_bp:
-                logging.debug("Rejecting the read {} due to short spanning regions".format(read.query_name))
-                sema.release()
-                return
+                logging.debug("Rejecting the read {} due to short spanning regions".format(read_id))
+                return None
 
-            if read_region_start is not None and read_region_end is not None and read.seq is not None:
+            if read_region_start is not None and read_region_end is not None and sequence is not None:
                 # If deletion occurred on the right flanking region, we only get the remaining sequence.
-                result_seq = read.seq[read_region_start: read_region_end + right_flanking_bp]
-                spanning_reads.append(LoggedRead(sequence=result_seq,
-                                                 read_id=read.query_name,
-                                                 source=ReadSource.MAPPED))
-                length_distribution.append(len(result_seq) - left_flanking_bp - right_flanking_bp)
-        sema.release()
+                result_seq = sequence[read_region_start: read_region_end + right_flanking_bp]
+                spanning_read = LoggedRead(sequence=result_seq, read_id=read_id, source=ReadSource.MAPPED)
+                return spanning_read, len(result_seq) - left_flanking_bp - right_flanking_bp
+        return None
+
+    def map_in_pacbio_read_workers(self, function, tasks, chunksize=4):
+        """Yield function(task) for each task in order, computed by a pool of settings.CORES processes."""
+        if settings.CORES < 2:
+            init_pacbio_read_worker(self)
+            for task in tasks:
+                yield function(task)
+            return
+        pool = Pool(settings.CORES, initializer=init_pacbio_read_worker, initargs=(self,))
+        try:
+            for result in pool.imap(function, tasks, chunksize=chunksize):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
 
     @time_usage
     def get_spanning_reads_of_unaligned_pacbio_reads(self, unmapped_filtered_reads):
-        sema = Semaphore(settings.CORES)
-        manager = Manager()
-        shared_length_distribution = manager.list()
-        shared_spanning_reads = manager.list()
-
-        process_list = []
-        for read in unmapped_filtered_reads:
-            sema.acquire()
-            p = Process(target=self.check_if_pacbio_read_spans_vntr, args=(sema, read, shared_length_distribution,
-                                                                           shared_spanning_reads))
-            process_list.append(p)
-            p.start()
-        for p in process_list:
-            p.join()
-        logging.info('length_distribution of unmapped spanning reads: %s' % list(shared_length_distribution))
-        return list(shared_spanning_reads), list(shared_length_distribution)
+        unaligned_reads = ((read.query_name, str(read.seq)) for read in unmapped_filtered_reads)
+        length_distribution = []
+        spanning_reads = []
+        for read_spanning_reads, read_length_distribution in self.map_in_pacbio_read_workers(
+                get_spanning_regions_of_unaligned_pacbio_read_in_worker, unaligned_reads):
+            spanning_reads.extend(read_spanning_reads)
+            length_distribution.extend(read_length_distribution)
+        logging.info('length_distribution of unmapped spanning reads: %s' % length_distribution)
+        return spanning_reads, length_distribution
 
     @time_usage
     def get_spanning_reads_of_aligned_pacbio_reads(self, alignment_file):
-        sema = Semaphore(settings.CORES)
-        manager = Manager()
-        length_distribution = manager.list()
-        mapped_spanning_reads = manager.list()
-
         vntr_start = self.reference_vntr.start_point
         vntr_end = self.reference_vntr.start_point + self.reference_vntr.get_length()
         region_start = vntr_start
@@ -453,22 +604,26 @@ class VNTRFinder:
         samfile = pysam.AlignmentFile(alignment_file, read_mode, reference_filename=self.reference_filename)
         reference = get_reference_genome_of_alignment_file(samfile)
         chromosome = self.reference_vntr.chromosome if reference == 'HG19' else self.reference_vntr.chromosome[3:]
-        process_list = []
-        for read in samfile.fetch(chromosome, region_start, region_end):
-            if len(read.get_reference_positions()) == 0:
-                logging.debug('no reference positions for read. skipping self.check_if_pacbio_mapped_read_spans_vntr for this read')
-                continue
-            sema.acquire()
-            p = Process(target=self.check_if_pacbio_mapped_read_spans_vntr, args=(sema, read, length_distribution,
-                                                                                  mapped_spanning_reads))
-            process_list.append(p)
-            p.start()
 
-        for p in process_list:
-            p.join()
+        def get_mapped_reads():
+            # pysam reads cannot be sent to worker processes, so only the fields that are used are passed
+            for read in samfile.fetch(chromosome, region_start, region_end):
+                if len(read.get_reference_positions()) == 0:
+                    logging.debug('no reference positions for read. skipping this read')
+                    continue
+                yield read.query_name, read.seq, read.get_reference_positions(full_length=True)
+
+        length_distribution = []
+        mapped_spanning_reads = []
+        for result in self.map_in_pacbio_read_workers(get_spanning_region_of_mapped_pacbio_read_in_worker,
+                                                      get_mapped_reads()):
+            if result is not None:
+                spanning_read, length = result
+                mapped_spanning_reads.append(spanning_read)
+                length_distribution.append(length)
 
-        logging.info('length_distribution of mapped spanning reads: %s' % list(length_distribution))
-        return list(mapped_spanning_reads)
+        logging.info('length_distribution of mapped spanning reads: %s' % length_distribution)
+        return mapped_spanning_reads
 
     def get_conditional_likelihood(self, ck, ci, cj, ru_counts, r, r_e):
         if ck == ci == cj:
@@ -483,21 +638,17 @@ class VNTRFinder:
             return 0.5 * (r_e ** abs(ck-ci) + r_e ** abs(ck-cj))
 
     def find_genotype_based_on_observed_repeats(self, observed_copy_numbers):
-        ru_counts = {}
-        for cn in observed_copy_numbers:
-            if cn not in ru_counts.keys():
-                ru_counts[cn] = 0
-            ru_counts[cn] += 1
-        if len(ru_counts.keys()) < 2:
+        ru_counts = Counter(observed_copy_numbers)
+        if len(ru_counts) < 2:
             priors = 0.5
             ru_counts[0] = 1
         else:
-            priors = 1.0 / (len(ru_counts.keys()) * (len(ru_counts.keys())-1) / 2)
+            priors = 1.0 / (len(ru_counts) * (len(ru_counts)-1) / 2)
         import operator
         ru_counts = sorted(ru_counts.items(), key=operator.itemgetter(1), reverse=True)
         r = 0.03
         r_e = r / (2 + r)
-        prs = {}
+        prs = defaultdict(list)
         for ck, occ in ru_counts:
             if ck == 0:
                 continue
@@ -509,8 +660,6 @@ class VNTRFinder:
                     if self.is_haploid and i != j:
                         continue
                     cj = ru_counts[j][0]
-                    if (ci, cj) not in prs.keys():
-                        prs[(ci, cj)] = []
                     prs[(ci, cj)].append(self.get_conditional_likelihood(ck, ci, cj, ru_counts, r, r_e) ** occ)
 
         posteriors = {}
@@ -547,16 +696,19 @@ class VNTRFinder:
             self.minimum_right_flanking_size = settings.ACCURACY_FILTER_MIN_RIGHT_FLANKING_SIZE
         # max_copies = min(max_copies, 2 * len(self.reference_vntr.get_repeat_segments()))
         vntr_matcher = self.build_vntr_matcher_hmm(max_copies)
+        vntr_matcher_summary = get_model_state_summary(vntr_matcher)
         observed_copy_numbers = []
+        # Spanning reads are long and so is their viterbi matrix, so they are decoded one at a time
         for spanning_read in spanning_reads:
             read_sequence = spanning_read.sequence
             logp, vpath = vntr_matcher.viterbi(read_sequence)
-            repeats = get_number_of_repeats_in_vpath(vpath)
+            vpath_summary = get_vpath_summary(vpath, vntr_matcher_summary)
+            repeats = get_number_of_repeats_in_vpath(vpath_summary)
             observed_copy_numbers.append(repeats)
-            if log_pacbio_reads:
+            if log_pacbio_reads and logging.getLogger().isEnabledFor(logging.DEBUG):
                 logging.debug(read_sequence)
-                visited_states = [state.name for idx, state in vpath[1:-1]]
-                if self.read_flanks_repeats_with_confidence(vpath, read_sequence):
+                visited_states = vpath_summary.visited_states
+                if self.read_flanks_repeats_with_confidence(vpath_summary, read_sequence):
                     logging.debug('spanning read %s sourced from %s visited states :%s' % (spanning_read.read_id, spanning_read.source.name, visited_states))
                 else:
                     logging.debug('flanking read %s sourced from %s visited states :%s' % (spanning_read.read_id, spanning_read.source.name, visited_states))
@@ -602,7 +754,7 @@ class VNTRFinder:
         for haplotype in haplotypes:
             # print('haplotype: %s' % haplotype)
             logp, vpath = vntr_matcher.viterbi(haplotype)
-            rev_logp, rev_vpath = vntr_matcher.viterbi(str(Seq(haplotype).reverse_complement()))
+            rev_logp, rev_vpath = vntr_matcher.viterbi(get_reverse_complement(haplotype))
             if logp < rev_logp:
                 vpath = rev_vpath
             copy_numbers.append(get_number_of_repeats_in_vpath(vpath))
@@ -616,7 +768,7 @@ class VNTRFinder:
         if len(haplotypes) == 0:
             return None
         self.check_if_flanking_regions_align_to_str(haplotypes[0].upper(), read.read_id, flanking_region_lengths, new_spanning_reads)
-        reverse_complement_str = str(Seq(haplotypes[0]).reverse_complement())
+        reverse_complement_str = get_reverse_complement(haplotypes[0])
         self.check_if_flanking_regions_align_to_str(reverse_complement_str.upper(), read.read_id, flanking_region_lengths, new_spanning_reads)
         if len(flanking_region_lengths) > 0:
             return tuple([round(flanking_region_lengths[0] / len(self.reference_vntr.pattern))] * 2)
@@ -686,7 +838,7 @@ class VNTRFinder:
         min_improvement = 1
         for i in range(max_steps):
             old_fitness = fitness
-            current_vpaths = [(read.sequence, read.vpath) for read in updated_selected_reads + reference_repeats]
+            current_vpaths = [(read.sequence, read.vpath_summary) for read in updated_selected_reads + reference_repeats]
             hmm = get_read_matcher_model(left_flanking_region, right_flanking_region, None, copies, current_vpaths)
             updated_selected_reads = self.select_illumina_reads(alignment_file, unmapped_filtered_reads, False, hmm)
             fitness = sum([read.logp for read in selected_reads])
@@ -723,7 +875,10 @@ class VNTRFinder:
         recruitment_score = self.get_min_score_to_select_a_read(read_length)
 
         hmm = self.get_vntr_matcher_hmm(read_length=read_length)
+        hmm_summary = get_model_state_summary(hmm)
 
+        # Reads that need to be recruited are decoded together after the fetch, so they can share the cores
+        mapped_reads = []
         for read in samfile.fetch(chromosome, vntr_start, vntr_end):
             if read.is_unmapped or read.is_duplicate:
                 logging.debug('Rejecting duplicated read')
@@ -733,38 +888,54 @@ class VNTRFinder:
                 continue
             read_end = read.reference_end if read.reference_end else read.reference_start + len(read.seq)
             if vntr_start - read_length < read.reference_start < vntr_end or vntr_start < read_end < vntr_end:
-                if read.seq.count('N') <= 0:
-                    sequence = str(read.seq).upper()
-                    logp, vpath = hmm.viterbi(sequence)
-                    if is_low_quality_read(read) or not self.recruit_read(logp, vpath, recruitment_score, sequence):
-                        logging.debug('Rejected Aligned Read: %s' % sequence)
-                        continue
-                    selected_reads.append(SelectedRead(sequence=sequence,
-                                                       logp=logp,
-                                                       vpath=vpath,
-                                                       mapq=read.mapq,
-                                                       reference_start=read.reference_start,
-                                                       query_name=read.query_name))
-                end = min(read_end, vntr_end)
-                start = max(read.reference_start, vntr_start)
-                vntr_bp_in_mapped_reads += end - start
+                vntr_bp = min(read_end, vntr_end) - max(read.reference_start, vntr_start)
+                if 'N' in read.seq:
+                    vntr_bp_in_mapped_reads += vntr_bp
+                    continue
+                sequence = str(read.seq).upper()
+                if is_low_quality_read(read):
+                    logging.debug('Rejected Aligned Read: %s' % sequence)
+                    continue
+                mapped_reads.append((sequence, read.mapq, read.reference_start, read.query_name, vntr_bp))
+
+        decoded_reads = run_viterbi_on_sequences(hmm, [mapped_read[0] for mapped_read in mapped_reads])
+        for (sequence, mapq, reference_start, query_name, vntr_bp), (logp, vpath) in zip(mapped_reads, decoded_reads):
+            vpath_summary = get_vpath_summary(vpath, hmm_summary)
+            if not self.recruit_read(logp, vpath_summary, recruitment_score, sequence):
+                logging.debug('Rejected Aligned Read: %s' % sequence)
+                continue
+            selected_reads.append(SelectedRead(sequence=sequence,
+                                               logp=logp,
+                                               vpath=vpath,
+                                               vpath_summary=vpath_summary,
+                                               mapq=mapq,
+                                               reference_start=reference_start,
+                                               query_name=query_name))
+            vntr_bp_in_mapped_reads += vntr_bp
         logging.debug('vntr base pairs in mapped reads: %s' % vntr_bp_in_mapped_reads)
 
         dnn_model = None
         vntr_bp_in_unmapped_reads = Value('d', 0.0)
         model_file = settings.DNN_MODELS_DIR + '/%s.hd5' % self.reference_vntr.id
 
-        for read_segment in unmapped_filtered_reads:
-            if os.path.exists(model_file):
-                dnn_model = load_model(model_file)
-            if len(read_segment.seq) < read_length:
-                continue
-            if dnn_model is None:
-                self.process_unmapped_read(None, str(read_segment.seq), hmm, recruitment_score,
-                                           vntr_bp_in_unmapped_reads, selected_reads)
-            else:
-                self.process_unmapped_read_with_dnn(str(read_segment.seq), hmm, recruitment_score,
-                                                    vntr_bp_in_unmapped_reads, selected_reads, True, dnn_model)
+        read_segments = [str(read_segment.seq) for read_segment in unmapped_filtered_reads
+                         if len(read_segment.seq) >= read_length]
+        if len(read_segments) and os.path.exists(model_file):
+            dnn_model = load_model(model_file)
+        prescreen_strands = settings.PRESCREEN_UNMAPPED_READ_STRANDS
+        if dnn_model is None and settings.CORES > 1 and len(read_segments) > settings.CORES:
+            self.process_unmapped_reads_in_parallel(read_segments, hmm, recruitment_score, vntr_bp_in_unmapped_reads,
+                                                    selected_reads, prescreen_strands)
+        else:
+            for read_segment in read_segments:
+                if dnn_model is None:
+                    self.process_unmapped_read(None, read_segment, hmm, recruitment_score, vntr_bp_in_unmapped_reads,
+                                               selected_reads, prescreen_strands=prescreen_strands,
+                                               hmm_summary=hmm_summary)
+                else:
+                    self.process_unmapped_read_with_dnn(read_segment, hmm, recruitment_score,
+                                                        vntr_bp_in_unmapped_reads, selected_reads, True, dnn_model,
+                                                        hmm_summary)
 
         logging.debug('vntr base pairs in unmapped reads: %s' % vntr_bp_in_unmapped_reads.value)
 
@@ -807,11 +978,13 @@ class VNTRFinder:
         covered_repeats = []
         flanking_repeats = []
         total_counted_vntr_bp = 0
+        # Formatting the visited states of every read is only worth it when they are logged
+        log_visited_states = logging.getLogger().isEnabledFor(logging.DEBUG)
         for selected_read in selected_reads:
-            repeats = get_number_of_repeats_in_vpath(selected_read.vpath)
-            total_counted_vntr_bp += get_number_of_repeat_bp_matches_in_vpath(selected_read.vpath)
-            left_flanking_size_vpath = get_left_flanking_region_size_in_vpath(selected_read.vpath)
-            right_flanking_size_vpath = get_right_flanking_region_size_in_vpath(selected_read.vpath)
+            vpath_summary = selected_read.vpath_summary
+            repeats = get_number_of_repeats_in_vpath(vpath_summary)
+            total_counted_vntr_bp += selected_read.repeat_bps
+            left_flanking_size_vpath, right_flanking_size_vpath = get_flanking_region_sizes_in_vpath(vpath_summary)
             logging.debug('logp of read: %s' % str(selected_read.logp))
             logging.debug('left flanking size: %s' % left_flanking_size_vpath)
             logging.debug('right flanking size: %s' % right_flanking_size_vpath)
@@ -822,7 +995,6 @@ class VNTRFinder:
             #    or right_flanking_size_vpath < self.minimum_right_flanking_size):
             #        logging.debug('skipping read due to short left or right flanking size')
             #        continue
-            visited_states = [state.name for idx, state in selected_read.vpath[1:-1]]
             if selected_read.is_mapped:
                 read_source = ReadSource.MAPPED
             else:
@@ -830,17 +1002,19 @@ class VNTRFinder:
             logged_read = LoggedRead(sequence=selected_read.sequence,
                                      read_id=selected_read.query_name,
                                      source=read_source)
-            if self.read_flanks_repeats_with_confidence(selected_read.vpath, selected_read.sequence):
-                logging.debug('spanning read %s sourced from %s visited states :%s' % (
-                        logged_read.read_id, logged_read.source.name, visited_states))
+            if self.read_flanks_repeats_with_confidence(vpath_summary, selected_read.sequence):
+                if log_visited_states:
+                    logging.debug('spanning read %s sourced from %s visited states :%s' % (
+                            logged_read.read_id, logged_read.source.name, vpath_summary.visited_states))
                 logging.debug('repeats: %s' % repeats)
                 covered_repeats.append(repeats)
             elif not accuracy_filter:
                 # This may be read spanning VNTR region, but with poor alignment on flanking region.
                 # If accuracy_filter is true, we do not want to include spanning reads with
                 # poor alignment in flanking regions.
-                logging.debug('flanking read %s sourced from %s visited states :%s' % (
-                        logged_read.read_id, logged_read.source.name, visited_states))
+                if log_visited_states:
+                    logging.debug('flanking read %s sourced from %s visited states :%s' % (
+                            logged_read.read_id, logged_read.source.name, vpath_summary.visited_states))
                 logging.debug('repeats: %s' % repeats)
                 flanking_repeats.append(repeats)
             else:
@@ -913,11 +1087,13 @@ class VNTRFinder:
     @time_usage
     def find_hmm_score_of_simulated_reads(self, hmm, reads):
         initial_recruitment_score = -10000
-        manager = Manager()
-        processed_reads = manager.list([])
+        processed_reads = []
         vntr_bp_in_reads = Value('d', 0.0)
+        hmm_summary = get_model_state_summary(hmm)
+        # Every simulated read is decoded, so the trained recruitment threshold does not depend on the prescreen
         for read_segment in reads:
-            self.process_unmapped_read(None, read_segment, hmm, initial_recruitment_score, vntr_bp_in_reads, processed_reads, False)
+            self.process_unmapped_read(None, read_segment, hmm, initial_recruitment_score, vntr_bp_in_reads,
+                                       processed_reads, False, prescreen_strands=False, hmm_summary=hmm_summary)
         return processed_reads
 
     @time_usage
@@ -940,11 +1116,7 @@ class VNTRFinder:
         match_positions = []
         vntr_start = self.reference_vntr.start_point
         vntr_end = vntr_start + self.reference_vntr.get_length()
-        fasta_sequences = SeqIO.parse(open(reference_file), 'fasta')
-        for fasta in fasta_sequences:
-            name, sequence = fasta.id, str(fasta.seq)
-            if name != self.reference_vntr.chromosome:
-                continue
+        for name, sequence in read_fasta_sequences(reference_file, names=(self.reference_vntr.chromosome,)):
             window_hash = None
             for i in range(0, len(sequence) - keyword_size):
                 if sequence[i].upper() not in 'ACTG' or sequence[i - 1 + keyword_size].upper() not in 'ACTG':
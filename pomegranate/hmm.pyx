@@ -1955,7 +1955,8 @@ cdef class HiddenMarkovModel( GraphModel ):
 
         sequence_ndarray = _check_input(sequence, self)
         sequence_data = <double*> sequence_ndarray.data
-        logp = self._viterbi(sequence_data, path, n, m)
+        with nogil:
+            logp = self._viterbi(sequence_data, path, n, m)
 
         for i in range(n+m):
             if path[i] == -1:
@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from advntr.reference_vntr import ReferenceVNTR
@@ -42,3 +43,19 @@ class TestGenotyping(unittest.TestCase):
         read_length = 100
         results = vntr_finder.recruit_read(logp, vpath, min_score_to_count_read, read_length)
         self.assertEqual(results, True)
+
+    def test_simulated_reads_are_scored_without_strand_prescreen(self):
+        rng = random.Random(0)
+        pattern = 'CACAGTGGA'
+        ref_vntr = ReferenceVNTR(1, pattern, 1000, 'chr1', None, None)
+        ref_vntr.left_flanking_region = ''.join(rng.choice('ACGT') for _ in range(150))
+        ref_vntr.right_flanking_region = ''.join(rng.choice('ACGT') for _ in range(150))
+        ref_vntr.repeat_segments = [pattern]
+        vntr_finder = VNTRFinder(ref_vntr)
+        hmm = vntr_finder.build_vntr_matcher_hmm(vntr_finder.get_copies_for_hmm(150), 150)
+        # A repeat read with a substitution every 7 bp shares no 11-mer with the locus
+        substitutes = {'A': 'C', 'C': 'G', 'G': 'T', 'T': 'A'}
+        read = ''.join(substitutes[c] if i % 7 == 3 else c for i, c in enumerate((pattern * 17)[:150]))
+        self.assertEqual((0, 0), vntr_finder.get_strand_kmer_hits(read))
+        self.assertIsNone(vntr_finder.recruit_unmapped_read(read, hmm, -10000))
+        self.assertEqual(1, len(vntr_finder.find_hmm_score_of_simulated_reads(hmm, [read])))
@@ -1,4 +1,7 @@
 import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from advntr import hmm_utils
@@ -28,3 +31,41 @@ class TestHMMUtils(unittest.TestCase):
         correct_alignment = ['ACTT-A', 'A-TTGA']
         alignment = hmm_utils.get_multiple_alignment_of_viterbi_paths(repeats, states)
         self.assertEqual(alignment, correct_alignment)
+
+    def test_vpath_summary_masks(self):
+        visited_states = ['M1_suffix', 'I1_suffix', 'suffix_end_suffix', 'unit_start_1', 'M1_1', 'D2_1', 'I2_1',
+                          'unit_end_1', 'prefix_start_prefix', 'M1_prefix']
+        summary = hmm_utils.VPathSummary(visited_states)
+        self.assertEqual([True, False, False, False, True, False, False, False, False, True], list(summary.is_match))
+        self.assertEqual([1, 1, -1, -1, 1, 2, 2, -1, -1, 1], list(summary.hmm_index))
+        self.assertEqual(2, hmm_utils.get_left_flanking_region_size_in_vpath(summary))
+        self.assertEqual(1, hmm_utils.get_right_flanking_region_size_in_vpath(summary))
+        self.assertEqual(2, hmm_utils.get_number_of_repeat_bp_matches_in_vpath(summary))
+        self.assertEqual([2], hmm_utils.get_repeating_pattern_lengths(visited_states))
+
+    def test_vpath_summary_taken_from_model_states(self):
+        visited_states = ['M1_suffix', 'suffix_end_suffix', 'unit_start_1', 'M1_1', 'I1_1', 'unit_end_1']
+        model_summary = hmm_utils.VPathSummary(['unit_end_1', 'M1_1', 'M1_suffix', 'I1_1', 'unit_start_1',
+                                                'suffix_end_suffix'])
+        summary = model_summary.take([2, 5, 4, 1, 3, 0])
+        expected = hmm_utils.VPathSummary(visited_states)
+        self.assertEqual(visited_states, summary.visited_states)
+        self.assertEqual(list(expected.is_emitting), list(summary.is_emitting))
+        self.assertEqual(list(expected.hmm_index), list(summary.hmm_index))
+        self.assertEqual(hmm_utils.get_repeating_pattern_lengths(expected),
+                         hmm_utils.get_repeating_pattern_lengths(summary))
+
+    def test_model_arrays_round_trip(self):
+        model = hmm_utils.get_prefix_matcher_hmm('ACGTTGCAGGTA')
+        output_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(output_dir, 'model.npz')
+            hmm_utils.save_model_arrays(model, file_name)
+            loaded_model = hmm_utils.load_model_arrays(file_name)
+        finally:
+            shutil.rmtree(output_dir)
+        self.assertEqual([state.name for state in model.states], [state.name for state in loaded_model.states])
+        logp, vpath = model.viterbi('ACGATGCAGG')
+        loaded_logp, loaded_vpath = loaded_model.viterbi('ACGATGCAGG')
+        self.assertAlmostEqual(logp, loaded_logp)
+        self.assertEqual([state.name for idx, state in vpath], [state.name for idx, state in loaded_vpath])